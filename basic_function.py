@@ -3,6 +3,8 @@ import numpy as np
 import os
 import fnmatch
 
+from lib_profiler import profiler
+
 def show_img(name, img):
     """
     Show the image
@@ -34,22 +36,172 @@ def find_files(directory, pattern):
     
     return file_list
 
+# Source & destination points of the perspective transform
+# SRC_POINTS = np.float32([[(555, 665), (1365, 0), (1625, 0), (2585, 665)]])
+SRC_POINTS = np.float32([[(440, 645), (1350, 0), (1785, 0), (2585, 645)]])
+DST_POINTS = np.float32([[(1350, 940), (1350, 0), (1785, 0), (1785, 940)]])
+# DST_POINTS = np.float32([[(300, 0), (400, 0), (400, 150), (300, 150)]])
+
+# Columns of the bev image which are used to find the lines, [x_start, x_end)
+BEV_X_RANGE = (1200, 2000)
+
+# Cache of the perspective transforms, keyed by image size and points
+_warp_cache = {}
+# Matrices of get_M_Minv, built at the first call
+_M_Minv = None
+
+class PerspectiveWarp(object):
+    """
+    Perspective transform with the matrices (and optionally the remap tables) computed once
+    """
+    def __init__(self, img_size, src=SRC_POINTS, dst=DST_POINTS, remap=False, x_range=None):
+        """
+        Init
+
+        Parameters:
+            img_size: (width, height) of the image to be warped
+            src: source points in the original image
+            dst: destination points in the bev image
+            remap: use the precomputed fixed-point remap tables instead of warpPerspective, built at the first use
+            x_range: [x_start, x_end) of the bev columns to keep (BEV window), None for the full width
+        """
+        self.img_size = (int(img_size[0]), int(img_size[1]))
+
+        self.M = cv2.getPerspectiveTransform(src, dst)
+        self.Minv = cv2.getPerspectiveTransform(dst, src)
+
+        # BEV window: translate the destination so that only the useful columns are computed
+        if x_range is None:
+            self.x_offset, x_end = 0, self.img_size[0]
+        else:
+            self.x_offset, x_end = max(int(x_range[0]), 0), min(int(x_range[1]), self.img_size[0])
+            T = np.float64([[1, 0, -self.x_offset], [0, 1, 0], [0, 0, 1]])
+            self.M = T.dot(self.M)
+            self.Minv = self.Minv.dot(np.linalg.inv(T))
+        self.bev_size = (x_end - self.x_offset, self.img_size[1])
+
+        # The remap tables are built at the first use of each direction, e.g. the full resolution ones are never
+        # built for the downscaled processing without refinement
+        self.remap = remap
+        self.maps_warp = None
+        self.maps_unwarp = None
+
+    def warp(self, img, dst=None):
+        """
+        Warp the image into the bev
+
+        Parameters:
+            img: image in the original view
+            dst: optional output buffer
+
+        Return:
+            img_warp: image in the bev
+        """
+        if self.remap:
+            # remap() looks up the source pixel of every output pixel, so the forward warp uses Minv and vice versa
+            if self.maps_warp is None: self.maps_warp = build_remap(self.Minv, self.bev_size)
+            return cv2.remap(img, self.maps_warp[0], self.maps_warp[1], cv2.INTER_LINEAR, dst=dst)
+        return cv2.warpPerspective(img, self.M, self.bev_size, dst=dst, flags=cv2.INTER_LINEAR)
+
+    def unwarp(self, img, dst=None):
+        """
+        Warp the bev image back into the original view
+
+        Parameters:
+            img: image in the bev
+            dst: optional output buffer
+
+        Return:
+            img_unwarp: image in the original view
+        """
+        if self.remap:
+            if self.maps_unwarp is None: self.maps_unwarp = build_remap(self.M, self.img_size)
+            return cv2.remap(img, self.maps_unwarp[0], self.maps_unwarp[1], cv2.INTER_LINEAR, dst=dst)
+        return cv2.warpPerspective(img, self.Minv, self.img_size, dst=dst, flags=cv2.INTER_LINEAR)
+
+def build_remap(H, size):
+    """
+    Build the fixed-point remap tables of a perspective transform
+
+    Parameters:
+        H: 3x3 matrix mapping the output pixels to the source pixels
+        size: (width, height) of the output image
+
+    Return:
+        map1, map2: remap tables in CV_16SC2 & CV_16UC1
+    """
+    w, h = size
+    xs, ys = np.meshgrid(np.arange(w, dtype=np.float64), np.arange(h, dtype=np.float64))
+    d = H[2, 0]*xs + H[2, 1]*ys + H[2, 2]
+    map_x = ((H[0, 0]*xs + H[0, 1]*ys + H[0, 2]) / d).astype(np.float32)
+    map_y = ((H[1, 0]*xs + H[1, 1]*ys + H[1, 2]) / d).astype(np.float32)
+
+    return cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
+def get_warp(img_size, src=SRC_POINTS, dst=DST_POINTS, remap=False, x_range=None):
+    """
+    Get the cached perspective transform, which is built at the first call
+
+    Parameters:
+        img_size: (width, height) of the image to be warped
+        src: source points in the original image
+        dst: destination points in the bev image
+        remap: use the precomputed fixed-point remap tables instead of warpPerspective
+        x_range: [x_start, x_end) of the bev columns to keep (BEV window), None for the full width
+
+    Return:
+        warp: PerspectiveWarp
+    """
+    key = (int(img_size[0]), int(img_size[1]), np.float32(src).tobytes(), np.float32(dst).tobytes(), remap, None if x_range is None else tuple(x_range))
+    warp = _warp_cache.get(key)
+    if warp is None:
+        warp = _warp_cache[key] = PerspectiveWarp(img_size, src, dst, remap, x_range)
+
+    return warp
+
+def clear_warp_cache():
+    """
+    Drop all the cached perspective transforms, e.g. after re-calibration
+    """
+    global _M_Minv
+    _warp_cache.clear()
+    _M_Minv = None
+
 def get_M_Minv():
     """
     Get Perspective Transform
     """
-    # src = np.float32([[(555, 665), (1365, 0), (1625, 0), (2585, 665)]])
-    src = np.float32([[(440, 645), (1350, 0), (1785, 0), (2585, 645)]])
+    global _M_Minv
+    if _M_Minv is None:
+        _M_Minv = (cv2.getPerspectiveTransform(SRC_POINTS, DST_POINTS), cv2.getPerspectiveTransform(DST_POINTS, SRC_POINTS))
 
-    dst = np.float32([[(1350, 940), (1350, 0), (1785, 0), (1785, 940)]])
-    # dst = np.float32([[(300, 0), (400, 0), (400, 150), (300, 150)]])
+    return _M_Minv
 
-    M = cv2.getPerspectiveTransform(src, dst)
-    Minv = cv2.getPerspectiveTransform(dst,src)
+def get_buffer(buffers, name, shape, dtype=np.uint8):
+    """
+    Get a work buffer which is reused across the frames
 
-    return M, Minv
+    Parameters:
+        buffers: dict of the buffers, owned by the caller (e.g. LaneTracker), None for no reuse
+        name: name of the buffer
+        shape: shape of the buffer
+        dtype: dtype of the buffer
 
-def draw_area(img_origin, img_line, Minv, left_fit, right_fit):
+    Return:
+        buffer: uninitialized array, allocated at the first call for each (name, shape, dtype)
+    """
+    if buffers is None:
+        return np.empty(shape, dtype)
+
+    key = (name, tuple(shape), np.dtype(dtype))
+    buffer = buffers.get(key)
+    if buffer is None:
+        buffer = buffers[key] = np.empty(shape, dtype)
+
+    return buffer
+
+@profiler.timed('draw_area')
+def draw_area(img_origin, img_line, Minv, left_fit, right_fit, warp=None):
     """
     Draw the road area in the image
 
@@ -59,14 +211,18 @@ def draw_area(img_origin, img_line, Minv, left_fit, right_fit):
         Minv: inverse parameteres for perspective transform
         left_fit: [a,b,c]
         right_fit: [a,b,c]
+        warp: cached PerspectiveWarp, used instead of Minv if given
 
     Return:
         img_roadmask: mask of the road area
     """
+    # The fits are in the full bev, while img_line may only be the BEV window
+    x_offset = warp.x_offset if warp is not None else 0
+
     # Generate x and y values for plotting
     ploty = np.linspace(0, img_line.shape[0]-1, img_line.shape[0] )
-    left_fitx = left_fit[0]*ploty**2 + left_fit[1]*ploty + left_fit[2] + 5
-    right_fitx = right_fit[0]*ploty**2 + right_fit[1]*ploty + right_fit[2] - 5
+    left_fitx = left_fit[0]*ploty**2 + left_fit[1]*ploty + left_fit[2] + 5 - x_offset
+    right_fitx = right_fit[0]*ploty**2 + right_fit[1]*ploty + right_fit[2] - 5 - x_offset
 
     # Create an image to draw the lines on
     mask_road_warp = np.zeros_like(img_line).astype(np.uint8)
@@ -82,10 +238,14 @@ def draw_area(img_origin, img_line, Minv, left_fit, right_fit):
     mask_road_warp = cv2.addWeighted(mask_road_warp, 1, img_line, 1, 0)    
 
     # Warp the blank back to original image space using inverse perspective matrix (Minv)
-    img_roadmask = cv2.warpPerspective(mask_road_warp, Minv, (img_origin.shape[1], img_origin.shape[0]))
+    if warp is not None:
+        img_roadmask = warp.unwarp(mask_road_warp)
+    else:
+        img_roadmask = cv2.warpPerspective(mask_road_warp, Minv, (img_origin.shape[1], img_origin.shape[0]))
 
     return img_roadmask
 
+@profiler.timed('draw_demo')
 def draw_demo(img_result, img_bin, img_canny, img_line, img_line_warp, img_bev_result, curvature, distance_from_center, steer):
     """
     Generate the Demo image
@@ -145,7 +305,7 @@ def draw_demo(img_result, img_bin, img_canny, img_line, img_line_warp, img_bev_r
     img_demo[offset_y:(offset_y+show_h), offset_x*5+show_w*4:(offset_x+show_w)*5, :] = img_bev_result
 
     # Write the text
-    if abs(distance_from_center) <= 3.7:
+    if distance_from_center is not None and abs(distance_from_center) <= 3.7:
         pos_flag = 'right' if distance_from_center>0 else 'left'
         center_text = "Vehicle is %.2fm %s of center"%(abs(distance_from_center),pos_flag) 
         cv2.putText(img_demo,center_text,(w//2-500,h-50), cv2.FONT_HERSHEY_SIMPLEX, 2,(255,255,255),4)
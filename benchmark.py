@@ -0,0 +1,331 @@
+import os
+import sys
+import cv2
+import gc
+import json
+import time
+import argparse
+import subprocess
+import tracemalloc
+import numpy as np
+
+from basic_function import find_files, SRC_POINTS, DST_POINTS
+from lib_LaneDetector import LaneTracker, lane_region, ROI_TOP
+from lib_profiler import profiler
+from lib_video import VideoSource
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+######################################################
+###                   FUNCTIONS                    ###
+######################################################
+
+def synthetic_frame(t, size=(2592, 1944), seed=0):
+    """
+    Synthetic road image with two curved lane lines, drawn in the bev and warped into the camera view
+
+    Parameters:
+        t: time (s), which moves the lines & changes the curvature
+        size: (width, height) of the image
+        seed: seed of the noise
+
+    Return:
+        img: BGR image
+    """
+    w, h = size
+    roi_h = h - ROI_TOP
+    bev = np.full((roi_h, w), 90, np.uint8)
+    ys = np.arange(roi_h)
+    curve = 2e-5 * np.sin(t)
+    for x0 in (1400, 1740):
+        xs = x0 + curve * (ys - roi_h)**2 + 20 * np.sin(t * 0.7)
+        cv2.polylines(bev, [np.int32(np.transpose([xs, ys]))], False, 230, 16)
+
+    M = cv2.getPerspectiveTransform(SRC_POINTS, DST_POINTS)
+    img = np.full((h, w), 60, np.uint8)
+    img[ROI_TOP:] = cv2.warpPerspective(bev, M, (w, roi_h), flags=cv2.WARP_INVERSE_MAP, borderValue=90)
+    img = cv2.add(img, np.random.default_rng(seed).integers(0, 20, img.shape, dtype=np.uint8))
+
+    return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+
+def make_video(path, n_frames, fps=30, size=(2592, 1944)):
+    """
+    Write a synthetic lane video, for the machines without any recorded footage
+
+    Parameters:
+        path: output video (.avi, MJPG)
+        n_frames: number of frames
+        fps: frame rate
+        size: (width, height) of the frames
+    """
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, size)
+    for i in range(n_frames):
+        writer.write(synthetic_frame(i / float(fps), size, seed=i))
+    writer.release()
+
+def iter_frames(args):
+    """
+    Frames of the video, the directory of images, or the synthetic road
+
+    Parameters:
+        args: arguments of the command line
+
+    Return:
+        generator of the frames, the decoding time (or the waiting time for the prefetched frame) is recorded as the 'decode' stage
+    """
+    if args.synthetic:
+        for i in range(args.synthetic):
+            with profiler.span('decode'):
+                frame = synthetic_frame(i / 30., seed=i)
+            yield frame
+    elif args.frames_dir:
+        for path in sorted(find_files(args.frames_dir, args.pattern)):
+            with profiler.span('decode'):
+                frame = cv2.imread(path)
+            if frame is not None: yield frame
+    elif args.prefetch:
+        source = VideoSource(args.video, queue_size=args.prefetch)
+        if not source.open(): return
+        # The decoder is stopped even if the generator is closed before the end
+        try:
+            while True:
+                with profiler.span('decode'):
+                    frame = source.grab()
+                if frame is None: break
+                yield frame.image
+                frame.release()
+        finally:
+            source.close()
+    else:
+        cap = cv2.VideoCapture(args.video)
+        while True:
+            with profiler.span('decode'):
+                ret, frame = cap.read()
+            if not ret or frame is None: break
+            yield frame
+        cap.release()
+
+def peak_rss_mb():
+    """
+    Peak resident memory of the process (MB), None if unknown (e.g. Windows)
+    """
+    if resource is None: return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return rss / 1024. / (1024. if sys.platform == 'darwin' else 1.)
+
+def git_commit():
+    """
+    Commit of the code being benchmarked, None if not in a git repository
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+def process(frame, tracker, detector, window, batch):
+    """
+    Run the lane (and object) pipeline on one frame
+
+    Parameters:
+        frame: BGR image
+        tracker: LaneTracker
+        detector: ObjectDetector, None for the lane only
+        window: frames waiting for the batched object detection, [(frame, region), ...]
+        batch: number of the frames detected in one batch
+
+    Return:
+        window: the frames still waiting
+    """
+    lane = tracker.update(frame)
+    region = lane_region(lane, frame.shape)
+
+    if detector is not None:
+        window.append((frame, region))
+        if len(window) == batch:
+            detector.detect_batch([item[0] for item in window], [item[1] for item in window], batch)
+            window = []
+
+    return window
+
+def run(args, detector=None):
+    """
+    Replay the frames through the lane (and object) pipeline, headless, and time each stage
+
+    Parameters:
+        args: arguments of the command line
+        detector: ObjectDetector, None for the lane only
+
+    Return:
+        report: dict saved as JSON
+    """
+    tracker = LaneTracker(scale=args.scale, refine=args.refine, remap=args.remap)
+
+    profiler.window = 1000000
+    profiler.enable()
+
+    n_frames, window = 0, []
+    time_start = None
+    # The first frames warm up the caches & buffers, they are not measured;
+    # the measurement starts before the next frame is decoded, so that its decoding is counted
+    if args.warmup == 0:
+        profiler.reset()
+        time_start = time.perf_counter()
+    frames = iter_frames(args)
+    try:
+        for i, frame in enumerate(frames):
+            with profiler.span('frame'):
+                window = process(frame, tracker, detector, window, args.batch)
+
+            if i >= args.warmup: n_frames += 1
+            if i + 1 == args.warmup:
+                profiler.reset()
+                time_start = time.perf_counter()
+            if args.max_frames and n_frames >= args.max_frames: break
+    finally:
+        frames.close()
+
+    elapsed = time.perf_counter() - time_start if time_start is not None else 0
+    profiler.disable()
+
+    stages = profiler.stats()
+    for s in stages.values():
+        s['throughput'] = 1000. / s['mean'] if s['mean'] > 0 else None
+
+    return {"commit": git_commit(), "config": vars(args), "frames": n_frames, "elapsed_s": elapsed,
+            "fps": n_frames / elapsed if elapsed > 0 else None, "peak_rss_mb": peak_rss_mb(),
+            "alloc_peak_mb_per_frame": None, "retained_blocks_per_frame": None,
+            "stages": stages}
+
+def traced_blocks():
+    """
+    Number of the live memory blocks traced by tracemalloc, after a full garbage collection
+    (the blocks of tracemalloc itself, e.g. of the previous snapshots, are not counted)
+
+    Return:
+        number of the blocks
+    """
+    gc.collect()
+    snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__), ))
+    return len(snapshot.traces)
+
+def measure_alloc(args, detector=None):
+    """
+    Replay the frames again with tracemalloc, in a pass of its own since the tracing slows every allocation down
+    (Python has no counter of the allocation events: the transient peak & the retained blocks stand for them)
+
+    Parameters:
+        args: arguments of the command line
+        detector: ObjectDetector, None for the lane only
+
+    Return:
+        peak_mb: maximum over the frames of the peak memory allocated on top of the live memory while processing a frame (MB)
+        retained_blocks: growth of the live blocks over the pass divided by the number of the frames, i.e. the blocks leaked per frame
+    """
+    tracker = LaneTracker(scale=args.scale, refine=args.refine, remap=args.remap)
+
+    n_frames, window, peak_mb, blocks_start = 0, [], 0., None
+    frames = iter_frames(args)
+    try:
+        for i, frame in enumerate(frames):
+            if i == args.warmup:
+                tracemalloc.start()
+                blocks_start = traced_blocks()
+
+            if tracemalloc.is_tracing():
+                current, _ = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+
+            window = process(frame, tracker, detector, window, args.batch)
+
+            if tracemalloc.is_tracing():
+                peak_mb = max(peak_mb, (tracemalloc.get_traced_memory()[1] - current) / 1e6)
+                n_frames += 1
+            if args.max_frames and n_frames >= args.max_frames: break
+
+        # The same treatment as at the start
+        blocks_end = traced_blocks() if tracemalloc.is_tracing() else None
+    finally:
+        frames.close()
+        if tracemalloc.is_tracing(): tracemalloc.stop()
+
+    if n_frames == 0: return None, None
+    return peak_mb, (blocks_end - blocks_start) / float(n_frames)
+
+def print_report(report, baseline=None):
+    """
+    Print the report, with the ratio of the mean latency to the baseline if given
+
+    Parameters:
+        report: result of run
+        baseline: report of a previous run (e.g. another commit), None for no comparison
+    """
+    print("commit {}: {} frames, {:.2f} fps, peak RSS {:.1f} MB".format(report['commit'], report['frames'], report['fps'] or 0, report['peak_rss_mb'] or 0))
+    if report['alloc_peak_mb_per_frame'] is not None:
+        print("memory (separate pass, not timed): transient peak {:.1f} MB per frame, {:.2f} blocks retained per frame".format(report['alloc_peak_mb_per_frame'], report['retained_blocks_per_frame']))
+
+    header = ['stage', 'count', 'mean(ms)', 'p50(ms)', 'p95(ms)', 'p99(ms)', 'calls/s'] + (['vs base'] if baseline else [])
+    print('{:>24}'.format(header[0]) + ''.join(['{:>12}'.format(h) for h in header[1:]]))
+    for name, s in sorted(report['stages'].items()):
+        row = '{:>24}{:>12}'.format(name, s['count']) + ''.join(['{:>12.3f}'.format(s[k]) for k in ('mean', 'p50', 'p95', 'p99', 'throughput')])
+        if baseline:
+            base = baseline['stages'].get(name)
+            row += '{:>12}'.format('{:.2f}x'.format(s['mean'] / base['mean']) if base and base['mean'] > 0 else '-')
+        print(row)
+
+######################################################
+###                    BEGINING                    ###
+######################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay recorded frames through the lane & object pipelines headless, and measure each stage")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--video', default="./video.mp4", help="recorded video")
+    source.add_argument('--frames-dir', default=None, help="directory of the recorded images")
+    source.add_argument('--synthetic', default=0, type=int, help="number of synthetic frames, without any recording")
+    parser.add_argument('--pattern', default="*.jpg", help="pattern of the images in --frames-dir")
+    parser.add_argument('--make-video', default=None, help="only write a synthetic video of --synthetic (or 300) frames to this path")
+    parser.add_argument('--prefetch', default=0, type=int, help="decode the video ahead in a background thread, with a queue of this many frames")
+    parser.add_argument('--max-frames', default=0, type=int, help="maximum number of measured frames, 0 for all")
+    parser.add_argument('--warmup', default=5, type=int, help="number of the first frames not measured")
+    parser.add_argument('--scale', default=1, type=int, help="downscaling factor of the lane detection")
+    parser.add_argument('--refine', action='store_true', help="refine the downscaled fits at the full resolution")
+    parser.add_argument('--remap', action='store_true', help="warp with the precomputed remap tables instead of warpPerspective")
+    parser.add_argument('--object', action='store_true', help="run the object detection too")
+    parser.add_argument('--model', default=None, help="exported Yolo model, None for the hub model")
+    parser.add_argument('--threads', default=None, type=int, help="number of the CPU threads of Yolo")
+    parser.add_argument('--crop', action='store_true', help="detect the objects only around the road area")
+    parser.add_argument('--batch', default=1, type=int, help="number of the frames detected in one batch")
+    parser.add_argument('--alloc', action='store_true', help="measure the transient peak memory & the retained blocks per frame with tracemalloc, in a second pass not timed")
+    parser.add_argument('--json', default=None, help="save the report as JSON")
+    parser.add_argument('--baseline', default=None, help="JSON report of a previous run to compare with")
+    args = parser.parse_args()
+
+    if args.make_video:
+        make_video(args.make_video, args.synthetic or 300)
+        print("Synthetic video written to {}".format(args.make_video))
+        sys.exit(0)
+
+    detector = None
+    if args.object:
+        from lib_ObjectDetector import ObjectDetector
+        detector = ObjectDetector(args.model, args.threads, crop=args.crop)
+
+    report = run(args, detector)
+    if report['frames'] == 0:
+        raise SystemExit("No frame measured")
+    if args.alloc:
+        report['alloc_peak_mb_per_frame'], report['retained_blocks_per_frame'] = measure_alloc(args, detector)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
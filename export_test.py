@@ -0,0 +1,128 @@
+import os
+import time
+import argparse
+import numpy as np
+
+from scale_test import load_frames
+from lib_ObjectDetector import ObjectDetector, export_model
+
+######################################################
+###                   FUNCTIONS                    ###
+######################################################
+
+def run_model(detector, frames, batch):
+    """
+    Run the detector on the frames, after one warm-up batch
+
+    Parameters:
+        detector: ObjectDetector
+        frames: list of the frames
+        batch: number of the frames in one call
+
+    Return:
+        results: predictions [x1, y1, x2, y2, confidence, class] (normalized) of each frame
+        times: time cost of each frame (s)
+    """
+    detector.model.to(detector.device)
+    # One untimed batch first, which includes the initialization of the graph (TorchScript / ONNX Runtime)
+    detector.model(frames[:batch])
+
+    results, times = [], []
+    for i in range(0, len(frames), batch):
+        time_tik = time.time()
+        preds = detector.model(frames[i:i+batch]).xyxyn
+        time_cost = time.time() - time_tik
+
+        for pred in preds:
+            results.append(pred.numpy() if hasattr(pred, 'numpy') else np.asarray(pred))
+            times.append(time_cost / len(preds))
+
+    return results, np.float64(times)
+
+def box_iou(boxes1, boxes2):
+    """
+    IoU of every pair of boxes
+
+    Parameters:
+        boxes1, boxes2: [[x1, y1, x2, y2], ...]
+
+    Return:
+        iou: len(boxes1) x len(boxes2)
+    """
+    lt = np.maximum(boxes1[:, None, :2], boxes2[None, :, :2])
+    rb = np.minimum(boxes1[:, None, 2:4], boxes2[None, :, 2:4])
+    inter = np.prod(np.clip(rb - lt, 0, None), axis=2)
+    area1 = np.prod(boxes1[:, 2:4] - boxes1[:, :2], axis=1)
+    area2 = np.prod(boxes2[:, 2:4] - boxes2[:, :2], axis=1)
+
+    return inter / (area1[:, None] + area2[None, :] - inter + 1e-12)
+
+def compare(ref, res, iou_thres=0.5):
+    """
+    Match the detections with the reference ones (same class, greedy by IoU)
+
+    Parameters:
+        ref: reference predictions of each frame
+        res: predictions of each frame
+        iou_thres: minimum IoU of a match
+
+    Return:
+        precision, recall: ratio of the matched detections & reference detections
+        iou: mean IoU of the matches
+    """
+    matched, ious, n_ref, n_res = 0, [], 0, 0
+    for ref_det, res_det in zip(ref, res):
+        n_ref, n_res = n_ref + len(ref_det), n_res + len(res_det)
+        if len(ref_det) == 0 or len(res_det) == 0: continue
+
+        iou = box_iou(ref_det, res_det) * (ref_det[:, None, 5] == res_det[None, :, 5])
+        while True:
+            i, j = np.unravel_index(np.argmax(iou), iou.shape)
+            if iou[i, j] < iou_thres: break
+            matched += 1
+            ious.append(iou[i, j])
+            iou[i, :], iou[:, j] = 0, 0
+
+    return matched / max(n_res, 1), matched / max(n_ref, 1), np.mean(ious) if ious else np.nan
+
+######################################################
+###                    BEGINING                    ###
+######################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Latency & accuracy of the exported Yolo against the eager hub model")
+    parser.add_argument('--video', default="./video.mp4", help="recorded video")
+    parser.add_argument('--model', default="./yolov5s.onnx", help="exported model (.torchscript or .onnx), exported first if it does not exist")
+    parser.add_argument('--int8', action='store_true', help="dynamic int8 quantization when exporting (ONNX only)")
+    parser.add_argument('--threads', default=None, type=int, help="number of the CPU threads")
+    parser.add_argument('--batch', default=1, type=int, help="number of the frames in one call")
+    parser.add_argument('--frames', default=100, type=int, help="maximum number of frames")
+    parser.add_argument('--csv', default=None, help="save the report as csv")
+    args = parser.parse_args()
+
+    frames = load_frames(args.video, args.frames)
+    if not frames:
+        raise SystemExit("No frame in {}".format(args.video))
+
+    if not os.path.exists(args.model):
+        export_model(args.model, batch=args.batch, int8=args.int8)
+
+    # The eager hub model is the reference
+    ref, ref_times = run_model(ObjectDetector(threads=args.threads), frames, args.batch)
+    res, res_times = run_model(ObjectDetector(args.model, args.threads), frames, args.batch)
+    precision, recall, iou = compare(ref, res)
+
+    header = ['model', 'time_mean(ms)', 'time_p95(ms)', 'fps', 'precision', 'recall', 'iou_mean']
+    rows = [['eager', np.mean(ref_times)*1000, np.percentile(ref_times, 95)*1000, 1/np.mean(ref_times), 1, 1, 1],
+            [os.path.basename(args.model), np.mean(res_times)*1000, np.percentile(res_times, 95)*1000, 1/np.mean(res_times), precision, recall, iou]]
+
+    print("{} frames of {}, batch {}, threads {}".format(len(frames), args.video, args.batch, args.threads))
+    print(''.join(['{:>19}'.format(h) for h in header]))
+    for row in rows:
+        print('{:>19}'.format(row[0]) + ''.join(['{:>19.4f}'.format(v) for v in row[1:]]))
+
+    if args.csv:
+        with open(args.csv, 'w') as f:
+            f.write(','.join(header) + '\n')
+            for row in rows:
+                f.write(','.join([row[0]] + ['{:.6f}'.format(v) for v in row[1:]]) + '\n')
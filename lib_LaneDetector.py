@@ -2,16 +2,161 @@
 import cv2
 import numpy as np
 
-from basic_function import show_img, get_M_Minv, draw_area, draw_demo
+from basic_function import show_img, get_warp, get_buffer, draw_area, draw_demo, SRC_POINTS, DST_POINTS, BEV_X_RANGE
+from lib_profiler import profiler
 
-def detect_line(img_input, steer, memory={"left_fit":[0.0, 0.0, 0.0],"right_fit":[0.0, 0.0, 0.0],"left_x":0.0,"right_x":0.0}, debug=False):
+# First row of the full frame used for the lane detection
+ROI_TOP = 1000
+
+# Structuring element of the morphological operations, built once
+# (OpenCV applies a full rectangle as separable row & column passes)
+KERNEL_LINE = cv2.getStructuringElement(cv2.MORPH_RECT,(11,11))
+_kernels = {1: KERNEL_LINE}
+
+class LaneTracker(object):
+    """
+    Lane detector keeping the line-fit parameters and the work buffers across the frames, one tracker per camera
+    """
+    __slots__ = ('track', 'smooth', 'bev_dilate', 'scale', 'refine', 'remap', 'debug', 'left_fit', 'right_fit', 'left_x', 'right_x', 'confident', 'buffers', 'lane')
+
+    def __init__(self, track=True, smooth=0.0, bev_dilate=True, scale=1, refine=False, remap=False, debug=False):
+        """
+        Init
+
+        Parameters:
+            track: search around the previous fits while they are confident (see find_line)
+            smooth: weight of the previous fits in the exponential smoothing, 0 for no smoothing
+            bev_dilate: dilate the lines again after warping (see locate_line)
+            scale: downscaling factor of the processing, e.g. 1, 2, 4 (see locate_line)
+            refine: refine the downscaled fits at the full resolution (see refine_line)
+            remap: warp with the precomputed remap tables instead of warpPerspective (see basic_function.PerspectiveWarp)
+            debug: show the intermediate images
+        """
+        self.track = track
+        self.smooth = smooth
+        self.bev_dilate = bev_dilate
+        self.scale = scale
+        self.refine = refine
+        self.remap = remap
+        self.debug = debug
+
+        # Work buffers reused across the frames, see basic_function.get_buffer
+        self.buffers = {}
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the line-fit parameters, e.g. after a camera switch
+        """
+        self.left_fit = np.zeros(3)
+        self.right_fit = np.zeros(3)
+        self.left_x = 0
+        self.right_x = 0
+        self.confident = False
+        self.lane = None
+
+    @property
+    def memory(self):
+        """
+        Memory of the line-fit parameters, in the format of detect_line
+        """
+        return {"left_fit":self.left_fit, "right_fit":self.right_fit, "left_x":self.left_x, "right_x":self.right_x, "confident":self.confident}
+
+    def update(self, frame, draw=False, y_offset=0):
+        """
+        Detect the lane in a new frame
+
+        Parameters:
+            frame: original image
+            draw: draw the line result in bev for render
+            y_offset: row of the full frame at the top of the image, e.g. lib_pipeline.Frame.offset[1] for a sensor ROI
+
+        Return:
+            lane: see locate_line, the images in it are only valid until the next update
+        """
+        # The last lane already holds the memory of the line-fit parameters
+        # The fits are smoothed before the curvature & distance are calculated, so the control uses the smoothed lane
+        lane = locate_line(frame, self.lane if self.lane is not None else {}, debug=self.debug, track=self.track, draw=draw, buffers=self.buffers,
+                           bev_dilate=self.bev_dilate, scale=self.scale, refine=self.refine, y_offset=y_offset, smooth=self.smooth, remap=self.remap)
+
+        self.left_fit, self.right_fit = np.asarray(lane['left_fit'], np.float64), np.asarray(lane['right_fit'], np.float64)
+        self.left_x, self.right_x = lane['left_x'], lane['right_x']
+        self.confident = lane['confident']
+        self.lane = lane
+
+        return lane
+
+    def render(self, frame, steer):
+        """
+        Draw the last detected lane
+
+        Parameters:
+            frame: the image given to the last update
+            steer: real steer of the vehicle to display
+
+        Return:
+            img_result: demo image
+            img_area: image for lane area
+        """
+        return render_line(frame, self.lane, steer)
+
+class LaneRegion(object):
+    """
+    Road area as a table of the [x_left, x_right] interval of each image row, for the O(1) tests of the points without any mask image
+    """
+    __slots__ = ('left', 'right', 'top', 'shape')
+
+    def __init__(self, left, right, top, shape):
+        """
+        Init
+
+        Parameters:
+            left, right: x of the left & right boundaries of the rows from top
+            top: first image row of the table
+            shape: (height, width) of the image
+        """
+        self.left = left
+        self.right = right
+        self.top = top
+        self.shape = shape
+
+    def contains(self, x, y):
+        """
+        Test whether the points fall into the road area
+
+        Parameters:
+            x, y: pixel coordinates of the points (arrays of int)
+
+        Return:
+            inside: bool array
+        """
+        rows = np.asarray(y) - self.top
+        valid = (rows >= 0) & (rows < len(self.left))
+        rows = np.where(valid, rows, 0)
+
+        return valid & (x >= self.left[rows]) & (x <= self.right[rows])
+
+    def bbox(self):
+        """
+        Bounding box of the road area
+
+        Return:
+            [x_start, y_start, x_end, y_end], None if the area is empty
+        """
+        rows = np.flatnonzero(self.left <= self.right)
+        if len(rows) == 0: return None
+
+        return [int(np.floor(self.left[rows].min())), self.top + int(rows[0]), int(np.ceil(self.right[rows].max())) + 1, self.top + int(rows[-1]) + 1]
+
+def detect_line(img_input, steer, memory=None, debug=False, track=False):
     """
     Main Function
 
     Parameters:
     img: original image
     steer: real steer of the vehicle to display
-    memory: memory of the line-fit parameters
+    memory: memory of the line-fit parameters, None for the first frame
+    track: search around the previous fits while they are confident (see find_line)
 
     Return:
     img_result: demo image
@@ -20,90 +165,337 @@ def detect_line(img_input, steer, memory={"left_fit":[0.0, 0.0, 0.0],"right_fit"
     memory: memory of the line-fit parameters
     img_area: image for lane area
     """
+    if memory is None: memory = {}
+    lane = locate_line(img_input, memory, debug, track, draw=True)
+    img_result, img_area = render_line(img_input, lane, steer)
+
+    memory = {"left_fit":lane['left_fit'], "right_fit":lane['right_fit'], "left_x":lane['left_x'], "right_x":lane['right_x'], "confident":lane['confident']}
+
+    return img_result, lane['distance_from_center'], lane['curvature'],  memory, img_area
+
+@profiler.timed('locate_line')
+def locate_line(img_input, memory, debug=False, track=False, draw=False, buffers=None, bev_dilate=True, scale=1, refine=False, y_offset=0, smooth=0.0, remap=False):
+    """
+    Detect the lane without any visualization, i.e. the geometric part of detect_line
+
+    Parameters:
+    img_input: original image (BGR or 1-channel, e.g. MONO8 frames)
+    memory: memory of the line-fit parameters (the returned lane can be used directly)
+    track: search around the previous fits while they are confident (see find_line)
+    draw: draw the line result in bev for render_line
+    buffers: work buffers reused across the frames (see LaneTracker), the images in the lane are then only valid until the next call
+    bev_dilate: dilate the lines again in the BEV window, which thickens the far lines stretched by the warp
+    scale: downscaling factor, the pre-processing & line search run on the image downscaled by it, the fits are mapped back to the full resolution
+    refine: refine the downscaled fits at the full resolution (see refine_line)
+    y_offset: row of the full frame at the top of img_input, i.e. the image is cropped by a sensor ROI starting at or above ROI_TOP (full width)
+    smooth: weight of the memory fits in the exponential smoothing while the lines are tracked, 0 for no smoothing
+    remap: warp with the precomputed remap tables instead of warpPerspective (see basic_function.PerspectiveWarp)
+
+    Return:
+    lane: dict of
+        left_fit, right_fit, left_x, right_x, confident: memory of the line-fit parameters
+        curvature
+        distance_from_center:  positive--Right   negetive--Left   None--not sure
+        warp: PerspectiveWarp of the BEV window (full resolution)
+        roi_top: first row of img_input used for the lane detection
+        img_line, img_bin, img_canny, img_line_warp, img_bev_result: intermediate images for render_line (downscaled if scale > 1)
+    """
+    if img_input.ndim == 3 and img_input.shape[2] == 1: img_input = img_input[:, :, 0]
+    roi_top = ROI_TOP - y_offset
+    if roi_top < 0: raise ValueError("The image starts at row {} of the frame, below the lane ROI (row {})".format(y_offset, ROI_TOP))
+    # The warp, BEV_X_RANGE & the distance from the center are calibrated in the full-frame columns
+    if img_input.shape[1] <= SRC_POINTS[..., 0].max():
+        raise ValueError("The image must span the full frame width, it is only {} wide".format(img_input.shape[1]))
+    img = img_input[roi_top:, :]
+    warp = get_warp(img.shape[1::-1], remap=remap, x_range=BEV_X_RANGE)
+    memory_left, memory_right, memory_confident = memory.get('left_fit'), memory.get('right_fit'), memory.get('confident', False)
+
+    # Downscale
+    if scale > 1:
+        small_shape = (img.shape[0]//scale, img.shape[1]//scale) + img.shape[2:]
+        img_small = cv2.resize(img, small_shape[1::-1], dst=get_buffer(buffers, 'small', small_shape), interpolation=cv2.INTER_AREA)
+        warp_small = get_warp(img_small.shape[1::-1], SRC_POINTS/scale, DST_POINTS/scale, remap, x_range=(BEV_X_RANGE[0]//scale, BEV_X_RANGE[1]//scale))
+        memory = {"left_fit":scale_fit(memory.get('left_fit', np.zeros(3)), 1./scale), "right_fit":scale_fit(memory.get('right_fit', np.zeros(3)), 1./scale), "confident":memory.get('confident', False)}
+    else:
+        img_small, warp_small = img, warp
+
     # Pre-process
-    img = img_input[1000:, :]
-    img_line, img_bin, img_canny = pre_process(img, debug)
+    img_line, img_bin, img_canny = pre_process(img_small, debug, buffers, line_kernel(scale))
     
     # Get warp_line 
-    M, Minv = get_M_Minv()
-    img_line_warp = cv2.warpPerspective(img_line, M, img.shape[1::-1], flags=cv2.INTER_LINEAR)
-    img_line_warp[:, :1200] = 0
-    img_line_warp[:, 2000:] = 0
-    kernel_ed = cv2.getStructuringElement(cv2.MORPH_RECT,(11,11))
-    img_line_warp= cv2.dilate(img_line_warp,kernel_ed,2)
+    # Only the BEV window is warped, the columns outside are never used
+    with profiler.span('warp'):
+        bev_shape = warp_small.bev_size[::-1]
+        img_line_warp = warp_small.warp(img_line, dst=get_buffer(buffers, 'line_warp', bev_shape))
+        if bev_dilate:
+            img_line_warp= cv2.dilate(img_line_warp,line_kernel(scale),dst=get_buffer(buffers, 'line_warp_dilate', bev_shape))
     if debug: show_img('warp', img_line_warp)
     
     # Detect line & Calculate the value
-    left_fit, right_fit, left_x, right_x, img_bev_result = find_line(img_line_warp, memory, debug)
-    curvature, distance_from_center = calculate_curv_and_pos(img_line_warp, left_fit, right_fit)
+    left_fit, right_fit, left_x, right_x, img_bev_result, confident = find_line(img_line_warp, memory, debug, x_offset=warp_small.x_offset, width=warp_small.img_size[0], track=track, draw=draw, scale=scale)
+
+    # Back to the full resolution
+    if scale > 1:
+        left_fit, right_fit = scale_fit(left_fit, scale), scale_fit(right_fit, scale)
+        left_x, right_x = left_x*scale, right_x*scale
+        if refine: left_fit, right_fit = refine_line(img, left_fit, right_fit, warp, buffers, bev_dilate)
+
+    # Smooth the fits while the lines are tracked (the memory being the last smoothed lane)
+    if smooth > 0 and confident and memory_confident:
+        left_fit = smooth*np.asarray(memory_left, np.float64) + (1-smooth)*left_fit
+        right_fit = smooth*np.asarray(memory_right, np.float64) + (1-smooth)*right_fit
+
+    curvature, distance_from_center = calculate_curv_and_pos(img_line_warp, left_fit, right_fit, width=warp.img_size[0], height=warp.bev_size[1])
+    # Not sure: out of the lane, or NaN / inf (e.g. the zero fits when no line is found)
+    if not abs(distance_from_center) <= 3.7: distance_from_center = None
+
+    return {"left_fit":left_fit, "right_fit":right_fit, "left_x":left_x, "right_x":right_x, "confident":confident,
+            "curvature":curvature, "distance_from_center":distance_from_center, "warp":warp, "roi_top":roi_top,
+            "img_line":img_line, "img_bin":img_bin, "img_canny":img_canny, "img_line_warp":img_line_warp, "img_bev_result":img_bev_result}
+
+def line_kernel(scale):
+    """
+    Structuring element of the morphological operations for the downscaled image
+
+    Parameters:
+    scale: downscaling factor
+
+    Return:
+    kernel: cached rectangle kernel
+    """
+    kernel = _kernels.get(scale)
+    if kernel is None:
+        size = max(11//scale, 3)
+        kernel = _kernels[scale] = cv2.getStructuringElement(cv2.MORPH_RECT,(size,size))
+
+    return kernel
+
+def scale_fit(fit, scale):
+    """
+    Scale the line-fit parameters, i.e. x' = scale*x at y' = scale*y
+
+    Parameters:
+    fit: [a,b,c]
+    scale: scaling factor
+
+    Return:
+    fit: [a/scale, b, c*scale]
+    """
+    return np.float64([fit[0]/scale, fit[1], fit[2]*scale])
+
+@profiler.timed('refine_line')
+def refine_line(img, left_fit, right_fit, warp, buffers=None, bev_dilate=True, margin=20):
+    """
+    Refine the fits found in the downscaled image using the full resolution pixels near them
+
+    Parameters:
+    img: ROI of the original image
+    left_fit, right_fit: fits in the full bev coordinates
+    warp: PerspectiveWarp of the BEV window (full resolution)
+    buffers: work buffers reused across the frames
+    bev_dilate: dilate the lines again in the BEV window
+    margin: half width of the searching area around the fits
+
+    Return:
+    left_fit, right_fit: refined fits, or the given ones if the refinement is not confident
+    """
+    # Columns of the original image covered by the lines
+    ploty = np.linspace(0, warp.bev_size[1]-1, 20)
+    pts = [np.transpose([np.polyval(fit, ploty) + d - warp.x_offset, ploty]) for fit in (left_fit, right_fit) for d in (-margin, margin)]
+    pts = cv2.perspectiveTransform(np.float64(pts).reshape(1, -1, 2), warp.Minv)[0]
+    x_start = min(max(int(pts[:, 0].min()) - 16, 0), img.shape[1])
+    x_end = max(min(int(pts[:, 0].max()) + 16, img.shape[1]), x_start)
+    if x_end - x_start < 16: return left_fit, right_fit
+
+    # Pre-process the covered columns only
+    # (undecorated, so that the crop is timed as a part of refine_line, not as a full-frame pre_process)
+    img_line_crop, _, _ = pre_process.__wrapped__(img[:, x_start:x_end])
+    img_line = get_buffer(buffers, 'refine_line', img.shape[:2])
+    img_line[:] = 0
+    img_line[:, x_start:x_end] = img_line_crop
+
+    bev_shape = warp.bev_size[::-1]
+    img_line_warp = warp.warp(img_line, dst=get_buffer(buffers, 'refine_warp', bev_shape))
+    if bev_dilate:
+        img_line_warp = cv2.dilate(img_line_warp, KERNEL_LINE, dst=get_buffer(buffers, 'refine_warp_dilate', bev_shape))
+
+    result = search_around_poly(img_line_warp, left_fit, right_fit, warp.x_offset, margin, draw=False)
+    if result is None: return left_fit, right_fit
+
+    return result[0], result[1]
+
+def render_line(img_input, lane, steer):
+    """
+    Draw the lane detected by locate_line
+
+    Parameters:
+    img_input: original image (BGR or 1-channel, converted to BGR for the display)
+    lane: result of locate_line
+    steer: real steer of the vehicle to display
+
+    Return:
+    img_result: demo image
+    img_area: image for lane area
+    """
+    if img_input.ndim == 2 or img_input.shape[2] == 1: img_input = cv2.cvtColor(img_input, cv2.COLOR_GRAY2BGR)
+    roi_top = lane['roi_top']
+    img = img_input[roi_top:, :]
+    img_bev_result = lane['img_bev_result']
+    if img_bev_result is None: img_bev_result = cv2.cvtColor(lane['img_line_warp'], cv2.COLOR_GRAY2BGR)
+    if img_bev_result.shape[1::-1] != lane['warp'].bev_size: img_bev_result = cv2.resize(img_bev_result, lane['warp'].bev_size, interpolation=cv2.INTER_NEAREST)
 
     # # Draw results on the image
-    img_area = draw_area(img, img_bev_result, Minv, left_fit, right_fit)
-    img_result = img_result = cv2.addWeighted(img, 1, img_area, 0.3, 0)
-    img_result = np.vstack([img_input[0:1001, :], img_result])
-    img_area = np.vstack([np.zeros_like(img_input)[0:1001, :], img_area])
-    img_result, distance_from_center = draw_demo(img_result, img_bin, img_canny, img_line, img_line_warp, img_bev_result, curvature, distance_from_center, steer)
+    img_area = draw_area(img, img_bev_result, lane['warp'].Minv, lane['left_fit'], lane['right_fit'], lane['warp'])
+    img_result = cv2.addWeighted(img, 1, img_area, 0.3, 0)
+    img_result = np.vstack([img_input[0:roi_top+1, :], img_result])
+    img_area = np.vstack([np.zeros_like(img_input)[0:roi_top+1, :], img_area])
+    img_result, _ = draw_demo(img_result, lane['img_bin'], lane['img_canny'], lane['img_line'], lane['img_line_warp'], img_bev_result, lane['curvature'], lane['distance_from_center'], steer)
 
-    memory = {"left_fit":left_fit, "right_fit":right_fit, "left_x":left_x, "right_x":right_x}
+    return img_result, img_area
 
-    return img_result, distance_from_center, curvature,  memory, img_area
+def lane_polygon(lane, num=50):
+    """
+    Get the polygon of the road area in the original image, without warping any image
 
+    Parameters:
+    lane: result of locate_line
+    num: number of points on each line
 
-def pre_process(img, debug=False):
+    Return:
+    pts: polygon [[x, y], ...] (int32) in the original image
+    """
+    warp = lane['warp']
+    ploty = np.linspace(0, warp.bev_size[1]-1, num)
+    left_fitx = np.polyval(lane['left_fit'], ploty) + 5 - warp.x_offset
+    right_fitx = np.polyval(lane['right_fit'], ploty) - 5 - warp.x_offset
+    pts = np.vstack([np.transpose([left_fitx, ploty]), np.flipud(np.transpose([right_fitx, ploty]))])
+
+    # Project the polygon back into the original view
+    pts = cv2.perspectiveTransform(pts.reshape(1, -1, 2), lane['warp'].Minv)[0]
+    pts[:, 1] += lane['roi_top']
+
+    return np.int32(pts)
+
+def lane_mask(img_input, lane):
+    """
+    Lightweight mask of the road area for the headless mode, instead of the img_area of render_line
+
+    Parameters:
+    img_input: original image
+    lane: result of locate_line
+
+    Return:
+    mask: road area (255) in the original image (1-channel)
+    """
+    mask = np.zeros(img_input.shape[:2], np.uint8)
+    cv2.fillPoly(mask, [lane_polygon(lane)], 255)
+
+    return mask
+
+def lane_region(lane, shape, num=50):
+    """
+    Interval table of the road area, the same area as lane_mask without drawing it
+
+    Parameters:
+    lane: result of locate_line
+    shape: shape of the original image
+    num: number of points on each line
+
+    Return:
+    region: LaneRegion
+    """
+    pts = lane_polygon(lane, num)
+    left, right = pts[:num], pts[num:][::-1]
+
+    # The lines are sampled from the far end to the near end, i.e. by increasing image rows
+    top = max(int(min(left[:, 1].min(), right[:, 1].min())), 0)
+    bottom = min(int(max(left[:, 1].max(), right[:, 1].max())) + 1, shape[0])
+    rows = np.arange(top, max(bottom, top))
+    left_order, right_order = np.argsort(left[:, 1], kind='stable'), np.argsort(right[:, 1], kind='stable')
+    left_x = np.interp(rows, left[left_order, 1], left[left_order, 0], left=np.inf, right=np.inf)
+    right_x = np.interp(rows, right[right_order, 1], right[right_order, 0], left=-np.inf, right=-np.inf)
+
+    return LaneRegion(left_x, right_x, top, tuple(shape[:2]))
+
+@profiler.timed('pre_process')
+def pre_process(img, debug=False, buffers=None, kernel=KERNEL_LINE):
     """
     Image Preprocessing
 
     Parameters:
-    img: original image
+    img: original image (BGR, or 1-channel which is used directly as the gray image)
+    buffers: work buffers reused across the frames (see LaneTracker), the returned images are then only valid until the next call
+    kernel: structuring element of the close operation
 
     Return:
     img_line
     img_bin
     img_canny
     """
-    # BGR2GRAY
-    img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    shape = img.shape[:2]
+
+    # BGR2GRAY, no conversion for the 1-channel image
+    if img.ndim == 2 or img.shape[2] == 1:
+        img_gray = img.reshape(shape)
+    else:
+        img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=get_buffer(buffers, 'gray', shape))
 
     # Bin
-    _, img_bin = cv2.threshold(img_gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    _, img_bin = cv2.threshold(img_gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=get_buffer(buffers, 'bin', shape))
 
     if debug: show_img("BIN", img_bin)
     
     # Canny
-    img_blur = cv2.GaussianBlur(img_gray,(5,5),0) # 5
+    img_blur = cv2.GaussianBlur(img_gray,(5,5),0, dst=get_buffer(buffers, 'blur', shape)) # 5
     if debug: show_img("blur", img_blur)
-    img_canny = cv2.Canny(img_blur, 10, 60, apertureSize=3) #10 50
+    img_canny = cv2.Canny(img_blur, 10, 60, edges=get_buffer(buffers, 'canny', shape), apertureSize=3) #10 50
 
     if debug: show_img("Canny", img_canny)
     
     # Bin & Canny
-    img_line = cv2.bitwise_and(img_bin, img_canny)
+    img_line = cv2.bitwise_and(img_bin, img_canny, dst=get_buffer(buffers, 'line_and', shape))
     
-    kernel_ed = cv2.getStructuringElement(cv2.MORPH_RECT,(11,11))
-    img_line = cv2.dilate(img_line,kernel_ed,2)
-    img_line = cv2.erode(img_line,kernel_ed,2)    
+    # Close (dilate & erode) in one operation
+    img_line = cv2.morphologyEx(img_line, cv2.MORPH_CLOSE, kernel, dst=get_buffer(buffers, 'line', shape))
 
     if debug: show_img("Line", img_line) 
 
     return img_line, img_bin, img_canny
 
-def find_line(img, memory, debug=False):
+@profiler.timed('find_line')
+def find_line(img, memory, debug=False, x_offset=0, width=None, track=False, draw=True, scale=1):
     """
     Detect the lane using Sliding Windows Methods
 
     Parameters:
     img: warp_line (Bin)
     memory: memory of the line-fit parameters
+    x_offset: column of the full bev where img starts (BEV window)
+    width: width of the full bev, default img.shape[1]
+    track: search around the fits in memory if they are confident, the sliding windows are only used when it fails
+    draw: draw the line result in bev, otherwise the returned img is None
+    scale: downscaling factor of img, which scales the window size & thresholds
 
     Return:
     left_fit, right_fit
     format [a,b,c]
     y = a*x^2 + b*x + c    
+    (in the full bev coordinates)
+    left_x, right_x: base positions of the lines
+    img: line result in bev (BGR), None if not draw
+    confident: whether the fits can be tracked in the next frame
     """
+    if width is None: width = img.shape[1]
+
+    # Tracking mode
+    if track and memory.get('confident', False):
+        result = search_around_poly(img, memory['left_fit'], memory['right_fit'], x_offset, 50/scale, draw, scale)
+        if result is not None: return result
+
     # 在x方向上统计y方向上的像素和，推断道路线可能存在的x位置，进而确定左右侧道路线的起始点
     histogram = np.sum(img[img.shape[0]//2:,:], axis=0)
 
-    midpoint = np.int(histogram.shape[0]/2) + 300
+    midpoint = min(max(int(width/2) + 300//scale - x_offset, 1), histogram.shape[0]-1)
     leftx_base = np.argmax(histogram[:midpoint])
     rightx_base = np.argmax(histogram[midpoint:]) + midpoint
     # if memory:
@@ -127,25 +519,29 @@ def find_line(img, memory, debug=False):
     
     # Initialize the windows value
     windows_num = 10 # 9
-    windows_h = np.int(img.shape[0]/windows_num)
-    windows_w = 100
+    windows_h = int(img.shape[0]/windows_num)
+    windows_w = 100//scale
     # Current positions to be updated for each window
     leftx_current = leftx_base
     rightx_current = rightx_base
     # Set minimum number of pixels found to recenter window
-    minpix = 50 # 50
+    minpix = 50//scale**2 # 50
 
     # Identify the x and y positions of all nonzero pixels in the image
     nonzero = img.nonzero()
     nonzeroy = np.array(nonzero[0])
     nonzerox = np.array(nonzero[1])
 
+    # nonzero() scans row by row, so the pixels of each window row are one contiguous slice
+    # win_bounds[i+1]:win_bounds[i] --- pixels of the i-th window row (counted from the bottom)
+    win_bounds = np.searchsorted(nonzeroy, img.shape[0] - np.arange(windows_num+1)*windows_h)
+
     # Create empty lists to receive left and right lane pixel indices
     left_lane_inds = []
     right_lane_inds = []
     
     # GRAY2BGR
-    img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    img_bev = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR) if draw else None
 
     # Step through the windows one by one
     for i in range(windows_num):
@@ -158,21 +554,24 @@ def find_line(img, memory, debug=False):
         win_xright_high = rightx_current + windows_w//2
 
         # Draw the window
-        cv2.rectangle(img,(win_xleft_low,win_y_low),(win_xleft_high,win_y_high), (0,255,0), 2) 
-        cv2.rectangle(img,(win_xright_low,win_y_low),(win_xright_high,win_y_high), (0,255,0), 2) 
-
-        # Identify the nonzero pixels in x and y within the window
-        good_left_inds = ((nonzeroy >= win_y_low) & (nonzeroy < win_y_high) & (nonzerox >= win_xleft_low) & (nonzerox < win_xleft_high)).nonzero()[0]
-        good_right_inds = ((nonzeroy >= win_y_low) & (nonzeroy < win_y_high) & (nonzerox >= win_xright_low) & (nonzerox < win_xright_high)).nonzero()[0]
+        if draw:
+            cv2.rectangle(img_bev,(win_xleft_low,win_y_low),(win_xleft_high,win_y_high), (0,255,0), 2) 
+            cv2.rectangle(img_bev,(win_xright_low,win_y_low),(win_xright_high,win_y_high), (0,255,0), 2) 
+
+        # Identify the nonzero pixels in x and y within the window, only the pixels of the window row are checked
+        win_start = win_bounds[i+1]
+        win_x = nonzerox[win_start:win_bounds[i]]
+        good_left_inds = ((win_x >= win_xleft_low) & (win_x < win_xleft_high)).nonzero()[0] + win_start
+        good_right_inds = ((win_x >= win_xright_low) & (win_x < win_xright_high)).nonzero()[0] + win_start
         # Append these indices to the lists
         left_lane_inds.append(good_left_inds)
         right_lane_inds.append(good_right_inds)
 
         # If you found > minpix pixels, recenter next window on their mean position
         if len(good_left_inds) > minpix:
-            leftx_current = np.int(np.mean(nonzerox[good_left_inds]))
+            leftx_current = int(np.mean(nonzerox[good_left_inds]))
         if len(good_right_inds) > minpix:        
-            rightx_current = np.int(np.mean(nonzerox[good_right_inds]))
+            rightx_current = int(np.mean(nonzerox[good_right_inds]))
 
     # Concatenate the arrays of indices
     left_lane_inds = np.concatenate(left_lane_inds)
@@ -185,25 +584,109 @@ def find_line(img, memory, debug=False):
     righty = nonzeroy[right_lane_inds]
 
     # Draw the left & right line
-    for i in range(len(leftx)): img[lefty[i]][leftx[i]] = [0,0,255]
-    for i in range(len(rightx)): img[righty[i]][rightx[i]] = [255,0,0]
+    if draw:
+        img_bev[lefty, leftx] = [0,0,255]
+        img_bev[righty, rightx] = [255,0,0]
 
     # Fit a second order polynomial to each
     # left_fit = np.polyfit(lefty, leftx, 2)
     # right_fit = np.polyfit(righty, rightx, 2)
+    confident = True
     try:
-        left_fit = np.polyfit(lefty, leftx, 2)
+        left_fit = np.polyfit(lefty, leftx + x_offset, 2)
     except:
-        left_fit = memory['left_fit']
+        left_fit = memory.get('left_fit', np.zeros(3))
+        confident = False
     
     try:
-        right_fit = np.polyfit(righty, rightx, 2)
+        right_fit = np.polyfit(righty, rightx + x_offset, 2)
     except:
-        right_fit = memory['right_fit']
+        right_fit = memory.get('right_fit', np.zeros(3))
+        confident = False
+
+    confident = confident and check_lane(leftx + x_offset, lefty, rightx + x_offset, righty, left_fit, right_fit, img.shape[0], scale)
     
-    return left_fit, right_fit, leftx_base, rightx_base, img
+    return left_fit, right_fit, leftx_base + x_offset, rightx_base + x_offset, img_bev, confident
+
+def search_around_poly(img, left_fit, right_fit, x_offset=0, margin=50, draw=True, scale=1):
+    """
+    Detect the lane by searching around the previous fits
+
+    Parameters:
+    img: warp_line (Bin)
+    left_fit, right_fit: previous fits in the full bev coordinates
+    x_offset: column of the full bev where img starts (BEV window)
+    margin: half width of the searching area around the previous fits
+    draw: draw the line result in bev
+    scale: downscaling factor of img, which scales the thresholds of check_lane
+
+    Return:
+    same as find_line, or None if the new fits are not confident
+    """
+    nonzero = img.nonzero()
+    nonzeroy = nonzero[0]
+    nonzerox = nonzero[1] + x_offset
+
+    # Select the pixels around the previous fits in one pass per line
+    left_lane_inds = np.abs(nonzerox - np.polyval(left_fit, nonzeroy)) < margin
+    right_lane_inds = np.abs(nonzerox - np.polyval(right_fit, nonzeroy)) < margin
+    leftx, lefty = nonzerox[left_lane_inds], nonzeroy[left_lane_inds]
+    rightx, righty = nonzerox[right_lane_inds], nonzeroy[right_lane_inds]
+
+    try:
+        left_fit = np.polyfit(lefty, leftx, 2)
+        right_fit = np.polyfit(righty, rightx, 2)
+    except:
+        return None
+
+    if not check_lane(leftx, lefty, rightx, righty, left_fit, right_fit, img.shape[0], scale):
+        return None
+
+    # Draw the left & right line
+    img_bev = None
+    if draw:
+        img_bev = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        img_bev[lefty, leftx - x_offset] = [0,0,255]
+        img_bev[righty, rightx - x_offset] = [255,0,0]
+
+    y_base = img.shape[0] - 1
+    left_x, right_x = int(np.polyval(left_fit, y_base)), int(np.polyval(right_fit, y_base))
+
+    return left_fit, right_fit, left_x, right_x, img_bev, True
+
+def check_lane(leftx, lefty, rightx, righty, left_fit, right_fit, height, scale=1, min_pix=500, max_residual=20, lane_width=(250, 650)):
+    """
+    Check whether the fits are confident enough to be tracked
+
+    Parameters:
+    leftx, lefty, rightx, righty: line pixels in the full bev coordinates
+    left_fit, right_fit: fits of the line pixels
+    height: height of the bev
+    scale: downscaling factor of the pixels, the thresholds below are given at the full resolution
+    min_pix: minimum number of pixels of each line
+    max_residual: maximum rms residual of each fit (pixel)
+    lane_width: [min, max] distance between the lines (pixel)
+
+    Return:
+    confident: True / False
+    """
+    if len(leftx) < min_pix/scale**2 or len(rightx) < min_pix/scale**2:
+        return False
+
+    # Residuals of the fits
+    if np.sqrt(np.mean((np.polyval(left_fit, lefty) - leftx)**2)) > max_residual/scale:
+        return False
+    if np.sqrt(np.mean((np.polyval(right_fit, righty) - rightx)**2)) > max_residual/scale:
+        return False
+
+    # Lane width at the top & bottom of the bev
+    ploty = np.float64([0, height-1])
+    lane_w = np.polyval(right_fit, ploty) - np.polyval(left_fit, ploty)
+
+    return bool(np.all(lane_w >= lane_width[0]/scale) and np.all(lane_w <= lane_width[1]/scale))
 
-def calculate_curv_and_pos(img_line, left_fit, right_fit):
+@profiler.timed('calculate_curv_and_pos')
+def calculate_curv_and_pos(img_line, left_fit, right_fit, width=None, height=None):
     """
     Calculate the curvature & distance from the center
 
@@ -211,12 +694,15 @@ def calculate_curv_and_pos(img_line, left_fit, right_fit):
     img_line: warp_line (Bin)
     left_fit: [a,b,c]
     right_fit: [a,b,c]
+    width: width of the full bev, default img_line.shape[1]
+    height: height of the full bev, default img_line.shape[0]
 
     Return:
     curvature, distance_from_center
     """
     # Define y-value where we want radius of curvature
-    ploty = np.linspace(0, img_line.shape[0]-1, img_line.shape[0] )
+    if height is None: height = img_line.shape[0]
+    ploty = np.linspace(0, height-1, height )
     leftx = left_fit[0]*ploty**2 + left_fit[1]*ploty + left_fit[2]
     rightx = right_fit[0]*ploty**2 + right_fit[1]*ploty + right_fit[2]
 
@@ -238,7 +724,8 @@ def calculate_curv_and_pos(img_line, left_fit, right_fit):
     lane_width = np.absolute(leftx[60] - rightx[60])
     lane_xm_per_pix = 3.7 / lane_width
     veh_pos = (((leftx[60] + rightx[60]) * lane_xm_per_pix) / 2.)
-    cen_pos = ((img_line.shape[1] * lane_xm_per_pix) / 2.)
+    if width is None: width = img_line.shape[1]
+    cen_pos = ((width * lane_xm_per_pix) / 2.)
     distance_from_center = cen_pos - veh_pos + 1.8
     
     return curvature, distance_from_center
@@ -1,32 +1,62 @@
 import torch
 import numpy as np
+import os
 import cv2
-from time import time
+import json
+import threading
+from collections import deque
+from time import time, monotonic, sleep
+
+from lib_pipeline import Worker
+from lib_profiler import profiler
+
+# Post-processing of the exported model, the same as the AutoShape wrapper of the hub model
+CONF_THRES = 0.25
+IOU_THRES = 0.45
+MAX_DET = 1000
 
 
 class ObjectDetector:
     """
     Class for the object detector based on Yolo5
     """
-    def __init__(self):
+    def __init__(self, model_path=None, threads=None, crop=False, crop_margin=(100, 400), crop_size=320):
         """
         Init
+
+        Parameters:
+            model_path: exported model (.torchscript or .onnx, see export_model) to run offline, None for the hub model
+            threads: number of the CPU threads of the inference, None for the default
+            crop: only detect in the bounding box of the road area plus the margin (see area_roi), the objects outside are not detected
+            crop_margin: (horizontal, upward[, downward]) margin around the road area (pixels), the upward one covers the bodies of the objects standing in the area; the downward one is the horizontal one if not given
+            crop_size: input size of the hub model in the crop mode (the exported model keeps its export size)
         """
+        self.model_path = model_path
+        self.threads = threads
+        self.crop = crop
+        self.crop_margin = crop_margin
+        self.crop_size = crop_size
         self.model = self.load_model()
         self.classes = self.model.names
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = 'cuda' if torch.cuda.is_available() and model_path is None else 'cpu'
 
         # the class mask
         self.class_care = ['person', 'bicycle', 'car', 'motorcycle', 'airplane', 'bus', 'truck', 'traffic light', 'fire hydrant','stop sign', 'parking meter', 'bench', 'cat', 'dog', 'chair']
+        # Lookup table of the class mask over the class ids
+        self.care = np.array([self.class_to_label(idx) in self.class_care for idx in range(len(self.classes))])
 
     def load_model(self):
         """
-        Load Yolo5 model from pytorch hub
+        Load Yolo5 model from pytorch hub, or the exported model from the local file
 
         Return: 
-            model: the trained pytorch model
+            model: the trained pytorch model, or ExportedModel
         """
-        model = torch.hub.load('ultralytics/yolov5', 'yolov5s', pretrained=True)
+        if self.model_path is not None:
+            model = ExportedModel(self.model_path, self.threads)
+        else:
+            if self.threads: torch.set_num_threads(self.threads)
+            model = torch.hub.load('ultralytics/yolov5', 'yolov5s', pretrained=True)
         print ("Load Success")
         return model
 
@@ -35,29 +65,78 @@ class ObjectDetector:
         Predict and analyze using yolo5
 
         Parameters:
-            frame: input frame in numpy/list/tuple format
-            img_area: image mask of the road area
+            frame: input frame in numpy/list/tuple format (BGR or 1-channel)
+            img_area: image mask of the road area (BGR or 1-channel), or lib_LaneDetector.LaneRegion
         
         Return:
-            labels: labels of the predictions
-            cord: coordinates of the predictions
-            colors: colors of the bounding-box for visualization, which distinguishes the dangerous level. i.e. red---dagerous   green---safe
+            labels: labels of the predictions (N)
+            cord: coordinates of the predictions (N x 5), [x1, y1, x2, y2, confidence] normalized by the image size
+            colors: colors of the bounding-box for visualization (N x 3), which distinguishes the dangerous level. i.e. red---dagerous   green---safe
+        """
+        return self.detect_batch([frame], [img_area])[0]
+
+    @profiler.timed('ObjectDetector.detect')
+    def detect_batch(self, frames, img_areas, max_batch=8):
+        """
+        Predict and analyze several frames (e.g. of several cameras, or a window of a video) with one call of yolo5 for each batch
+
+        Parameters:
+            frames: list of the input frames (BGR or 1-channel)
+            img_areas: list of the road areas (image masks or LaneRegion), one for each frame
+            max_batch: maximum number of the frames in one call
+
+        Return:
+            list of (labels, cord, colors) for each frame, see detect
         """
         self.model.to(self.device)
-        frame = [frame]
-        results = self.model(frame)
-        d_labels, d_cord = results.xyxyn[0][:, -1].numpy(), results.xyxyn[0][:, :-1].numpy()
-        labels = []
-        cord = []
-        colors = []
-        for i in range(len(d_labels)):
-            if self.class_to_label(d_labels[i]) in self.class_care and d_cord[i][4]>=0.4:
-                labels.append(d_labels[i])
-                cord.append(d_cord[i])
-
-                # Decide the dangerous level of the detected object according to whether it falls into the area
-                color = (0,0,255) if sum(img_area[int(d_cord[i][3]*img_area.shape[0])-1, int(d_cord[i][0]*img_area.shape[1])-1])+sum(img_area[int(d_cord[i][3]*img_area.shape[0])-1, int(d_cord[i][2]*img_area.shape[1])-1]) else (0,255,0)
-                colors.append(color)
+        # Yolo needs the color image, the MONO8 frames are expanded here only
+        frames = [cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR) if isinstance(frame, np.ndarray) and (frame.ndim == 2 or frame.shape[2] == 1) else frame for frame in frames]
+
+        # Crop mode: the predictions in the crops are mapped back to the normalized coordinates of the frames
+        rois = [area_roi(img_area, frame.shape, self.crop_margin) if self.crop else None for frame, img_area in zip(frames, img_areas)]
+        inputs = [frame if roi is None else frame[roi[1]:roi[3], roi[0]:roi[2]] for frame, roi in zip(frames, rois)]
+
+        # The crops are detected at the crop size, the full frames (e.g. without any road area) at the normal size
+        preds = [None] * len(frames)
+        for cropped in (True, False):
+            idx = [j for j, roi in enumerate(rois) if (roi is not None) == cropped]
+            for i in range(0, len(idx), max_batch):
+                batch = idx[i:i+max_batch]
+                results = self.model([inputs[j] for j in batch], size=self.crop_size) if cropped else self.model([inputs[j] for j in batch])
+                for j, pred in zip(batch, results.xyxyn): preds[j] = pred
+
+        detections = []
+        for pred, img_area, roi, frame in zip(preds, img_areas, rois, frames):
+            if roi is not None: pred = uncrop_pred(pred, roi, frame.shape)
+            detections.append(self.filter_detections(pred, img_area))
+
+        return detections
+
+    def filter_detections(self, pred, img_area):
+        """
+        Keep the cared classes with enough confidence, and decide their dangerous level
+
+        Parameters:
+            pred: predictions of one frame, [x1, y1, x2, y2, confidence, class] normalized by the image size
+            img_area: image mask of the road area (BGR or 1-channel), or lib_LaneDetector.LaneRegion
+
+        Return:
+            labels, cord, colors: see detect
+        """
+        pred = pred.numpy() if hasattr(pred, 'numpy') else np.asarray(pred)
+        pred = pred[self.care[pred[:, -1].astype(np.int64)] & (pred[:, 4] >= 0.4)]
+        labels, cord = pred[:, -1], pred[:, :-1]
+
+        # Decide the dangerous level of the detected objects according to whether their bottom corners fall into the area
+        h, w = img_area.shape[:2]
+        y = (cord[:, 3]*h).astype(np.int64) - 1
+        x1, x2 = (cord[:, 0]*w).astype(np.int64) - 1, (cord[:, 2]*w).astype(np.int64) - 1
+        if hasattr(img_area, 'contains'):
+            in_area = img_area.contains(x1, y) | img_area.contains(x2, y)
+        else:
+            in_area = (img_area[y, x1] != 0) | (img_area[y, x2] != 0)
+            if in_area.ndim == 2: in_area = in_area.any(axis=1)
+        colors = np.where(in_area[:, None], np.uint8([0,0,255]), np.uint8([0,255,0]))
 
         return labels, cord, colors
 
@@ -89,8 +168,417 @@ class ObjectDetector:
         for i in range(len(labels)):
             row = cord[i]
             x1, y1, x2, y2 = int(row[0]*x_shape), int(row[1]*y_shape), int(row[2]*x_shape), int(row[3]*y_shape)
-            cv2.rectangle(frame, (x1, y1), (x2, y2), colors[i], 4)
-            cv2.putText(frame, self.class_to_label(labels[i]), (x1, y1-2), cv2.FONT_HERSHEY_SIMPLEX, 1, colors[i], 2)
+            color = tuple(int(c) for c in colors[i])
+            cv2.rectangle(frame, (x1, y1), (x2, y2), color, 4)
+            cv2.putText(frame, self.class_to_label(labels[i]), (x1, y1-2), cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)
 
         return frame
-            
\ No newline at end of file
+
+
+class ExportedModel(object):
+    """
+    Yolo5 exported by export_model, run through TorchScript or ONNX Runtime on the CPU without the network
+    It is called like the hub model: model(frames).xyxyn
+    """
+    def __init__(self, path, threads=None):
+        """
+        Init
+
+        Parameters:
+            path: exported model (.torchscript or .onnx), with its meta data in path + '.json'
+            threads: number of the CPU threads of the inference, None for the default
+        """
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        self.names = meta['names']
+        self.img_size = tuple(meta['img_size'])
+        self.batch = meta['batch']
+
+        if path.endswith('.onnx'):
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if threads: options.intra_op_num_threads = threads
+            self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+            self.input_name = self.session.get_inputs()[0].name
+            self.net = None
+        else:
+            if threads: torch.set_num_threads(threads)
+            self.session = None
+            self.net = torch.jit.load(path, map_location='cpu').eval()
+
+    def to(self, device):
+        """
+        The exported model always runs on the CPU
+        """
+        return self
+
+    def __call__(self, frames, size=None):
+        """
+        Detect the objects in the frames
+
+        Parameters:
+            frames: list of the frames (BGR, given to the network as they are, like the hub model)
+            size: unused, the input size is fixed at the export
+
+        Return:
+            results: .xyxyn is the list of the predictions [x1, y1, x2, y2, confidence, class] (normalized by the frame size) of each frame
+        """
+        imgs, pads = zip(*[letterbox(frame, self.img_size) for frame in frames])
+        x = np.float32(imgs).transpose((0, 3, 1, 2)) / 255
+
+        # The TorchScript model only takes its export batch size, the last batch is padded
+        batch = len(frames) if self.batch is None else self.batch
+        preds = []
+        for i in range(0, len(x), batch):
+            chunk = x[i:i+batch]
+            if len(chunk) < batch: chunk = np.concatenate([chunk, np.zeros((batch - len(chunk),) + chunk.shape[1:], np.float32)])
+            if self.session is not None:
+                pred = self.session.run(None, {self.input_name: chunk})[0]
+            else:
+                with torch.no_grad():
+                    pred = self.net(torch.from_numpy(chunk))
+                pred = (pred[0] if isinstance(pred, (tuple, list)) else pred).numpy()
+            preds.extend(pred[:min(batch, len(x) - i)])
+
+        xyxyn = []
+        for pred, frame, (ratio, pad) in zip(preds, frames, pads):
+            det = non_max_suppression(pred)
+            # Back to the frame, normalized by its size
+            h, w = frame.shape[:2]
+            det[:, [0, 2]] = np.clip((det[:, [0, 2]] - pad[0]) / ratio, 0, w) / w
+            det[:, [1, 3]] = np.clip((det[:, [1, 3]] - pad[1]) / ratio, 0, h) / h
+            xyxyn.append(det)
+
+        return Detections(xyxyn)
+
+
+class Detections(object):
+    """
+    Results of ExportedModel, in the format of the hub model
+    """
+    def __init__(self, xyxyn):
+        self.xyxyn = xyxyn
+
+
+def area_roi(img_area, shape, margin=(100, 400), step=8):
+    """
+    Region of the frame to detect in: the bounding box of the road area plus the margin
+
+    Parameters:
+        img_area: image mask of the road area (BGR or 1-channel), or lib_LaneDetector.LaneRegion
+        shape: shape of the frame
+        margin: (horizontal, upward[, downward]) margin around the road area (pixels), the downward one is the horizontal one if not given
+        step: sampling step of the mask, the box is enlarged by it
+
+    Return:
+        roi: [x_start, y_start, x_end, y_end] in the frame, None for the full frame if there is no road area
+    """
+    if hasattr(img_area, 'bbox'):
+        box = img_area.bbox()
+        if box is None: return None
+    else:
+        mask = img_area[::step, ::step]
+        if mask.ndim == 3: mask = mask.any(axis=2)
+        rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+        if len(rows) == 0: return None
+        box = [cols[0]*step - step, rows[0]*step - step, cols[-1]*step + step, rows[-1]*step + step]
+
+    h, w = shape[:2]
+    x_start, x_end = max(box[0] - margin[0], 0), min(box[2] + margin[0], w)
+    down = margin[2] if len(margin) > 2 else margin[0]
+    y_start, y_end = max(box[1] - margin[1], 0), min(box[3] + down, h)
+
+    return [int(x_start), int(y_start), int(x_end), int(y_end)]
+
+def uncrop_pred(pred, roi, shape):
+    """
+    Map the predictions in a crop back to the frame
+
+    Parameters:
+        pred: predictions [x1, y1, x2, y2, confidence, class] normalized by the crop size
+        roi: [x_start, y_start, x_end, y_end] of the crop in the frame
+        shape: shape of the frame
+
+    Return:
+        pred: predictions normalized by the frame size
+    """
+    pred = (pred.numpy() if hasattr(pred, 'numpy') else np.asarray(pred)).copy()
+    h, w = shape[:2]
+    pred[:, [0, 2]] = (roi[0] + pred[:, [0, 2]] * (roi[2] - roi[0])) / w
+    pred[:, [1, 3]] = (roi[1] + pred[:, [1, 3]] * (roi[3] - roi[1])) / h
+
+    return pred
+
+def letterbox(img, size, color=(114, 114, 114)):
+    """
+    Resize the image keeping its ratio and pad it to the input size of the network, the same as the AutoShape wrapper
+
+    Parameters:
+        img: image
+        size: (height, width) of the network input
+        color: color of the padding
+
+    Return:
+        img: resized & padded image
+        (ratio, (pad_x, pad_y)): scaling ratio & padding, to map the boxes back
+    """
+    h, w = img.shape[:2]
+    ratio = min(size[0] / h, size[1] / w)
+    new_w, new_h = int(round(w * ratio)), int(round(h * ratio))
+    pad_x, pad_y = (size[1] - new_w) / 2, (size[0] - new_h) / 2
+
+    if (w, h) != (new_w, new_h):
+        img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    top, bottom = int(round(pad_y - 0.1)), int(round(pad_y + 0.1))
+    left, right = int(round(pad_x - 0.1)), int(round(pad_x + 0.1))
+    img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)
+
+    return img, (ratio, (pad_x, pad_y))
+
+def non_max_suppression(pred, conf_thres=CONF_THRES, iou_thres=IOU_THRES, max_det=MAX_DET):
+    """
+    Non-maximum suppression of the raw predictions of one image, the same as the AutoShape wrapper (per class, best class only)
+
+    Parameters:
+        pred: raw predictions [x, y, w, h, objectness, class scores...]
+        conf_thres: minimum confidence
+        iou_thres: maximum IoU with a kept box of the same class
+        max_det: maximum number of the detections
+
+    Return:
+        det: detections [x1, y1, x2, y2, confidence, class] in the network input
+    """
+    pred = pred[pred[:, 4] > conf_thres]
+    scores = pred[:, 5:] * pred[:, 4:5]
+    cls = scores.argmax(1)
+    conf = scores[np.arange(len(cls)), cls]
+    keep = conf > conf_thres
+    pred, cls, conf = pred[keep], cls[keep], conf[keep]
+
+    boxes = np.empty((len(pred), 4), np.float32)
+    boxes[:, :2] = pred[:, :2] - pred[:, 2:4] / 2
+    boxes[:, 2:] = pred[:, :2] + pred[:, 2:4] / 2
+
+    # Boxes of different classes never overlap after the class offset
+    offset_boxes = boxes + cls[:, None] * 4096.
+    area = (offset_boxes[:, 2] - offset_boxes[:, 0]) * (offset_boxes[:, 3] - offset_boxes[:, 1])
+    order = conf.argsort()[::-1]
+    kept = []
+    while order.size and len(kept) < max_det:
+        i = order[0]
+        kept.append(i)
+        others = order[1:]
+        inter_w = np.clip(np.minimum(offset_boxes[i, 2], offset_boxes[others, 2]) - np.maximum(offset_boxes[i, 0], offset_boxes[others, 0]), 0, None)
+        inter_h = np.clip(np.minimum(offset_boxes[i, 3], offset_boxes[others, 3]) - np.maximum(offset_boxes[i, 1], offset_boxes[others, 1]), 0, None)
+        inter = inter_w * inter_h
+        order = others[inter / (area[i] + area[others] - inter) <= iou_thres]
+
+    kept = np.int64(kept)
+    return np.hstack([boxes[kept], conf[kept, None], np.float32(cls[kept, None])]).astype(np.float32)
+
+def export_model(path, img_size=(480, 640), batch=1, int8=False):
+    """
+    Export the hub model (downloaded once) to a local file, which is loaded by ObjectDetector(model_path=path) without the network
+
+    Parameters:
+        path: output file, .torchscript or .onnx
+        img_size: (height, width) of the network input, (480, 640) keeps the 4:3 frames without padding like the hub model
+        batch: batch size of the TorchScript model (the ONNX model takes any batch size)
+        int8: dynamic int8 quantization of the weights, ONNX only
+    """
+    hub_model = torch.hub.load('ultralytics/yolov5', 'yolov5s', pretrained=True)
+    net = hub_model.model
+    net = getattr(net, 'model', net) if hasattr(net, 'pt') else net
+    net = net.float().eval()
+    x = torch.zeros((batch, 3) + tuple(img_size))
+
+    if path.endswith('.onnx'):
+        onnx_path = path + '.fp32' if int8 else path
+        torch.onnx.export(net, x, onnx_path, opset_version=12, input_names=['images'], output_names=['output'],
+                          dynamic_axes={'images': {0: 'batch'}, 'output': {0: 'batch'}})
+        if int8:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            # The intermediate fp32 model is only the input of the quantization
+            try:
+                quantize_dynamic(onnx_path, path, weight_type=QuantType.QUInt8)
+            finally:
+                os.remove(onnx_path)
+        batch = None
+    else:
+        if int8: raise ValueError("The int8 quantization is only supported by the ONNX export")
+        with torch.no_grad():
+            torch.jit.trace(net, x, strict=False).save(path)
+
+    names = hub_model.names
+    names = [names[i] for i in sorted(names)] if isinstance(names, dict) else list(names)
+    with open(path + '.json', 'w') as f:
+        json.dump({"names": names, "img_size": list(img_size), "batch": batch}, f)
+    print ("Export Success: {}".format(path))
+
+
+class AsyncObjectDetector(object):
+    """
+    Object detector running in its own thread at its own rate, so that it never blocks the lane & control loop
+    The latest frames of the cameras are detected together in one batch
+    """
+    def __init__(self, detector, period=0.0, area_history=10, max_batch=4, max_wait=0.0):
+        """
+        Init
+
+        Parameters:
+            detector: ObjectDetector
+            period: minimum time between two detections (s), 0 for running as fast as possible
+            area_history: number of the lane areas kept for each camera
+            max_batch: maximum number of the frames (cameras) detected in one batch
+            max_wait: maximum time to wait for the frames of more cameras after the first one (s), 0 for taking the waiting ones only
+        """
+        self.detector = detector
+        self.period = period
+        self.area_history = area_history
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        # Latest frame of each camera to detect, i.e. the stale frames are skipped
+        self._frames = {}
+        self._frames_cond = threading.Condition()
+        self._closed = False
+        # Recent lane areas & latest detections of each camera
+        self._areas = {}
+        self._results = {}
+        self._lock = threading.Lock()
+
+        self._worker = Worker("object", self._step)
+
+    def start(self):
+        """
+        Start the detection thread
+        """
+        self._worker.start()
+
+    def stop(self):
+        """
+        Stop the detection thread
+        """
+        self._worker.stop()
+        with self._frames_cond:
+            self._closed = True
+            self._frames_cond.notify_all()
+        self._worker.join()
+
+        # Release the frames not detected
+        with self._frames_cond:
+            items = list(self._frames.values())
+            self._frames.clear()
+        for item in items: self._done(item)
+
+    @property
+    def failed(self):
+        """
+        Whether the detection thread has failed
+        """
+        return self._worker.failed
+
+    def submit(self, frame, stamp, cam=0, release=None):
+        """
+        Feed a frame, which replaces the one of the same camera not detected yet
+
+        Parameters:
+            frame: input frame, which should not be modified afterwards
+            stamp: capture time of the frame (time.monotonic)
+            cam: index of the camera
+            release: function called when the frame is detected or skipped, e.g. Frame.release
+        """
+        with self._frames_cond:
+            stale = self._frames.pop(cam, None)
+            self._frames[cam] = (cam, stamp, frame, release)
+            self._frames_cond.notify()
+
+        if stale is not None: self._done(stale)
+
+    def publish_area(self, stamp, img_area, cam=0):
+        """
+        Publish the lane area of a frame, which is used to decide the dangerous level
+
+        Parameters:
+            stamp: capture time of the frame that the area is detected in
+            img_area: image mask of the road area (BGR or 1-channel), or lib_LaneDetector.LaneRegion (preferred, no mask image to draw)
+            cam: index of the camera
+        """
+        with self._lock:
+            if cam not in self._areas: self._areas[cam] = deque(maxlen=self.area_history)
+            self._areas[cam].append((stamp, img_area))
+
+    def latest(self, cam=0):
+        """
+        Get the latest detections without blocking
+
+        Parameters:
+            cam: index of the camera
+
+        Return:
+            (stamp, detections): capture time of the detected frame & the result of ObjectDetector.detect, None if no detection yet
+        """
+        with self._lock:
+            return self._results.get(cam)
+
+    def _closest_area(self, cam, stamp):
+        """
+        Get the lane area detected in the frame closest in time
+        """
+        with self._lock:
+            areas = self._areas.get(cam)
+            if not areas: return None
+            return min(areas, key=lambda area: abs(area[0] - stamp))[1]
+
+    def _done(self, item):
+        """
+        Release the frame which is detected or skipped
+        """
+        if item[3] is not None: item[3]()
+
+    def _take(self):
+        """
+        Take the latest frames of the cameras for a batch, waiting up to max_wait for more cameras after the first frame
+
+        Return:
+            items: list of (cam, stamp, frame, release), empty if timeout or stopped
+        """
+        with self._frames_cond:
+            if not self._frames and not self._closed:
+                self._frames_cond.wait(0.1)
+            if not self._frames: return []
+
+            deadline = monotonic() + self.max_wait
+            while len(self._frames) < self.max_batch and not self._closed:
+                time_left = deadline - monotonic()
+                if time_left <= 0: break
+                self._frames_cond.wait(time_left)
+
+            cams = sorted(self._frames, key=lambda cam: self._frames[cam][1])[:self.max_batch]
+            return [self._frames.pop(cam) for cam in cams]
+
+    def _step(self):
+        """
+        Detect the latest frames
+        """
+        items = self._take()
+        if not items: return
+
+        time_tik = monotonic()
+        try:
+            # The frames without any lane area yet are skipped
+            items_area = [(item, self._closest_area(item[0], item[1])) for item in items]
+            items_area = [(item, img_area) for item, img_area in items_area if img_area is not None]
+            if not items_area: return
+            detections = self.detector.detect_batch([item[2] for item, _ in items_area], [img_area for _, img_area in items_area], self.max_batch)
+        finally:
+            for item in items: self._done(item)
+
+        with self._lock:
+            for (item, _), result in zip(items_area, detections):
+                self._results[item[0]] = (item[1], result)
+
+        # Keep the own rate
+        time_left = self.period - (monotonic() - time_tik)
+        if time_left > 0: sleep(time_left)
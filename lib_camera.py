@@ -1,20 +1,101 @@
 import numpy as np
 import mvsdk
 import platform
+import threading
+from collections import deque
+from time import monotonic
+
+from lib_pipeline import Frame, LatestSlot, Worker
+from lib_profiler import profiler
+
+# Unit (s) of the timestamp from CameraGetFrameTimeStamp
+DEVICE_STAMP_UNIT = 1e-6
+
+
+class FrameRing(object):
+	"""
+	Ring of SDK-aligned frame buffers, each one is owned by a frame until released
+	"""
+	def __init__(self, buffer_size, count):
+		"""
+		Init
+
+		Parameters:
+			buffer_size: size of each buffer (bytes)
+			count: number of the buffers
+		"""
+		super(FrameRing, self).__init__()
+		self.buffers = [mvsdk.CameraAlignMalloc(buffer_size, 16) for i in range(count)]
+		self._free = deque(self.buffers)
+		self._cond = threading.Condition()
+
+	def acquire(self, timeout=None):
+		"""
+		Take a free buffer
+
+		Parameters:
+			timeout: maximum waiting time (s) if all the buffers are in use, None for no limit
+
+		Return:
+			address of the buffer, 0 if timeout
+		"""
+		with self._cond:
+			if not self._free:
+				self._cond.wait(timeout)
+			return self._free.popleft() if self._free else 0
+
+	def release(self, buffer):
+		"""
+		Give the buffer back to the ring
+
+		Parameters:
+			buffer: address of the buffer
+		"""
+		with self._cond:
+			self._free.append(buffer)
+			self._cond.notify()
+
+	def free(self):
+		"""
+		Free all the buffers, the frames using them must have been released
+		"""
+		for buffer in self.buffers:
+			mvsdk.CameraAlignFree(buffer)
+		self.buffers = []
+		self._free.clear()
+
 
 class Camera(object):
 	"""
 	Class for the industrial camera
 	"""
-	def __init__(self, DevInfo):
+	def __init__(self, DevInfo, ring_size=8, callback=False, queue_size=2, roi=None, mono=False):
 		"""
 		Init
+
+		Parameters:
+			DevInfo: device info from CameraEnumerateDevice
+			ring_size: number of the frame buffers, i.e. the maximum number of the frames held by the pipeline at the same time
+			callback: event-driven capture, the frames are pushed by the SDK callback thread instead of polling in grab()
+			queue_size: number of the latest frames kept in the callback mode, the older ones are dropped
+			roi: (x, y, width, height) of the sensor to capture, None for the full sensor; the rows outside are neither transferred nor processed by the ISP; it must span the full width (x = 0) for the lane detection
+			mono: output MONO8 even for a color sensor, i.e. one byte per pixel through the ISP for the lane-only pipeline
 		"""
 		super(Camera, self).__init__()
 		self.DevInfo = DevInfo
 		self.hCamera = 0
 		self.cap = None
-		self.pFrameBuffer = 0
+		self.ring_size = ring_size
+		self.ring = None
+		self.frame_count = 0
+		self.callback = callback
+		self.queue = LatestSlot(on_drop=lambda frame: frame.release(), size=queue_size) if callback else None
+		self.dropped = 0
+		self.roi = roi
+		self.mono = mono
+		self.offset = (0, 0)
+		# Recent differences between the host & the camera clocks, see frame_stamp
+		self.clock_offsets = deque(maxlen=100)
 
 	def open(self):
 		"""
@@ -35,18 +116,39 @@ class Camera(object):
 		cap = mvsdk.CameraGetCapability(hCamera)
 
 		# Get the type of the camera
-		monoCamera = (cap.sIspCapacity.bMonoSensor != 0)
+		monoCamera = (cap.sIspCapacity.bMonoSensor != 0) or self.mono
 
 		if monoCamera:
 			mvsdk.CameraSetIspOutFormat(hCamera, mvsdk.CAMERA_MEDIA_TYPE_MONO8)
 		else:
 			mvsdk.CameraSetIspOutFormat(hCamera, mvsdk.CAMERA_MEDIA_TYPE_BGR8)
 
-		# Calculate the size of the RGB buffer according to the maximum resolution
-		FrameBufferSize = cap.sResolutionRange.iWidthMax * cap.sResolutionRange.iHeightMax * (1 if monoCamera else 3)
+		# Sensor ROI: crop on the sensor side, or at least before the transfer if the sensor can not
+		if self.roi is not None:
+			x, y, width, height = self.roi
+			# The lane detection is calibrated in the full-frame columns, only the rows can be cropped
+			if x != 0 or width != cap.sResolutionRange.iWidthMax:
+				print("The sensor ROI must span the full width: x = 0, width = {}".format(cap.sResolutionRange.iWidthMax))
+				mvsdk.CameraUnInit(hCamera)
+				return False
+			if mvsdk.CameraSetImageResolutionEx(hCamera, 0xff, 0, 0, x, y, width, height, 0, 0) != mvsdk.CAMERA_STATUS_SUCCESS:
+				err_code = mvsdk.CameraSetTransferRoi(hCamera, 0, x, y, x + width, y + height)
+				# Otherwise the full frames would be tagged with the ROI offset, and overflow the buffers sized for the ROI
+				if err_code != mvsdk.CAMERA_STATUS_SUCCESS:
+					print("Set the sensor ROI Failed({}): {}".format(err_code, mvsdk.CameraGetErrorString(err_code)))
+					mvsdk.CameraUnInit(hCamera)
+					return False
+			self.offset = (x, y)
+			width_max, height_max = width, height
+		else:
+			self.offset = (0, 0)
+			width_max, height_max = cap.sResolutionRange.iWidthMax, cap.sResolutionRange.iHeightMax
 
-		# Allocate the RGB buffer for storing the ISP image
-		pFrameBuffer = mvsdk.CameraAlignMalloc(FrameBufferSize, 16)
+		# Calculate the size of the RGB buffer according to the maximum resolution (of the ROI)
+		FrameBufferSize = width_max * height_max * (1 if monoCamera else 3)
+
+		# Allocate the ring of RGB buffers for storing the ISP images
+		ring = FrameRing(FrameBufferSize, self.ring_size)
 
 		# Set the trigger mode for the camera: continurous mode
 		mvsdk.CameraSetTriggerMode(hCamera, 0)
@@ -55,12 +157,16 @@ class Camera(object):
 		mvsdk.CameraSetAeState(hCamera, 0)
 		mvsdk.CameraSetExposureTime(hCamera, 30 * 1000)
 
-		# Start to get the image
-		mvsdk.CameraPlay(hCamera)
-
 		self.hCamera = hCamera
-		self.pFrameBuffer = pFrameBuffer
+		self.ring = ring
 		self.cap = cap
+
+		# Callback mode: the SDK thread processes every frame once it arrives
+		if self.callback:
+			mvsdk.CameraSetCallbackFunction(hCamera, self.snap_proc, 0)
+
+		# Start to get the image
+		mvsdk.CameraPlay(hCamera)
 		return True
 
 	def close(self):
@@ -71,29 +177,227 @@ class Camera(object):
 			mvsdk.CameraUnInit(self.hCamera)
 			self.hCamera = 0
 
-		mvsdk.CameraAlignFree(self.pFrameBuffer)
-		self.pFrameBuffer = 0
+		if self.queue is not None:
+			self.queue.close()
+			self.queue.clear()
+
+		if self.ring is not None:
+			self.ring.free()
+			self.ring = None
 
+	@profiler.timed('Camera.grab')
 	def grab(self):
 		"""
 		Grab an image from the camera
+
+		Return:
+			frame: lib_pipeline.Frame owning one buffer of the ring without copy, which must be released after use; None if timeout or all the buffers are in use
 		"""
+		# Callback mode: take the oldest queued frame
+		if self.callback:
+			return self.queue.get(0.2)
+
 		hCamera = self.hCamera
-		pFrameBuffer = self.pFrameBuffer
+		pFrameBuffer = self.ring.acquire(0.2)
+		if not pFrameBuffer:
+			print("No free frame buffer, the frames are not released in time")
+			return None
+
 		try:
 			pRawData, FrameHead = mvsdk.CameraGetImageBuffer(hCamera, 200)
+			stamp, frame_id = self.frame_stamp()
 			mvsdk.CameraImageProcess(hCamera, pRawData, pFrameBuffer, FrameHead)
 			mvsdk.CameraReleaseImageBuffer(hCamera, pRawData)
 
-			if platform.system() == "Windows":
-				mvsdk.CameraFlipFrameBuffer(pFrameBuffer, FrameHead, 1)
-			
-			frame_data = (mvsdk.c_ubyte * FrameHead.uBytes).from_address(pFrameBuffer)
-			frame = np.frombuffer(frame_data, dtype=np.uint8)
-			frame = frame.reshape((FrameHead.iHeight, FrameHead.iWidth, 1 if FrameHead.uiMediaType == mvsdk.CAMERA_MEDIA_TYPE_MONO8 else 3) )
-			return frame
+			return self.make_frame(pFrameBuffer, FrameHead, stamp, frame_id)
 			
 		except mvsdk.CameraException as e:
+			self.ring.release(pFrameBuffer)
 			if e.error_code != mvsdk.CAMERA_STATUS_TIME_OUT:
 				print("CameraGetImageBuffer failed({}): {}".format(e.error_code, e.message) )
-			return None
\ No newline at end of file
+			return None
+
+	def frame_stamp(self):
+		"""
+		Get the capture time & the id of the latest frame from the camera, called as soon as the frame arrives
+
+		Return:
+			stamp: capture time of the frame in the host clock (time.monotonic), i.e. the camera timestamp plus the clock offset
+			frame_id: id of the frame given by the camera
+		"""
+		now = monotonic()
+		device_stamp = mvsdk.CameraGetFrameTimeStamp(self.hCamera) * DEVICE_STAMP_UNIT
+		frame_id = mvsdk.CameraGetFrameID(self.hCamera)
+
+		# The smallest recent difference is the one with the least transfer delay, the window follows the clock drift
+		self.clock_offsets.append(now - device_stamp)
+		return device_stamp + min(self.clock_offsets), frame_id
+
+	def make_frame(self, pFrameBuffer, FrameHead, stamp, frame_id):
+		"""
+		Wrap the processed image in the buffer of the ring into a frame
+
+		Parameters:
+			pFrameBuffer: buffer of the ring holding the ISP image
+			FrameHead: tSdkFrameHead of the image
+			stamp: capture time of the frame (time.monotonic)
+			frame_id: id of the frame
+
+		Return:
+			frame: lib_pipeline.Frame, which gives the buffer back to the ring when released
+		"""
+		if platform.system() == "Windows":
+			mvsdk.CameraFlipFrameBuffer(pFrameBuffer, FrameHead, 1)
+		
+		frame_data = (mvsdk.c_ubyte * FrameHead.uBytes).from_address(pFrameBuffer)
+		frame = np.frombuffer(frame_data, dtype=np.uint8)
+		frame = frame.reshape((FrameHead.iHeight, FrameHead.iWidth, 1 if FrameHead.uiMediaType == mvsdk.CAMERA_MEDIA_TYPE_MONO8 else 3) )
+
+		self.frame_count += 1
+		ring = self.ring
+		return Frame(frame, stamp, frame_id, lambda: ring.release(pFrameBuffer), self.offset)
+
+	@mvsdk.method(mvsdk.CAMERA_SNAP_PROC)
+	def snap_proc(self, hCamera, pRawData, pFrameHead, pContext):
+		"""
+		Callback of the SDK for each new frame (callback mode), called in the SDK thread
+		"""
+		FrameHead = pFrameHead[0]
+		stamp, frame_id = self.frame_stamp()
+
+		# Drop the frame if all the buffers are in use, the SDK thread must not be blocked
+		pFrameBuffer = self.ring.acquire(0)
+		if not pFrameBuffer:
+			mvsdk.CameraReleaseImageBuffer(hCamera, pRawData)
+			self.dropped += 1
+			return
+
+		try:
+			with profiler.span('Camera.snap_proc'):
+				mvsdk.CameraImageProcess(hCamera, pRawData, pFrameBuffer, FrameHead)
+				mvsdk.CameraReleaseImageBuffer(hCamera, pRawData)
+			self.queue.put(self.make_frame(pFrameBuffer, FrameHead, stamp, frame_id))
+		except mvsdk.CameraException as e:
+			self.ring.release(pFrameBuffer)
+			print("CameraImageProcess failed({}): {}".format(e.error_code, e.message) )
+
+
+class MultiCamera(object):
+	"""
+	Capture from several cameras concurrently (one thread for each) and emit the time-aligned frame sets
+	"""
+	def __init__(self, cams, tolerance=0.01, history=3):
+		"""
+		Init
+
+		Parameters:
+			cams: list of the opened Camera
+			tolerance: maximum difference between the capture times of the frames in a set (s)
+			history: number of the recent frames of each camera waiting to be matched, the older ones are dropped
+		"""
+		self.cams = cams
+		self.tolerance = tolerance
+		self.history = history
+		self.dropped = 0
+
+		# Latest frame set, the frames in the dropped sets are released
+		self.sets = LatestSlot(on_drop=lambda frames: [frame.release() for frame in frames])
+		self._pending = [deque() for cam in cams]
+		self._lock = threading.Lock()
+
+		self._workers = [Worker("capture{}".format(i), self._capture, i) for i in range(len(cams))]
+
+	def start(self):
+		"""
+		Start the capture threads
+		"""
+		for worker in self._workers:
+			worker.start()
+
+	def stop(self):
+		"""
+		Stop the capture threads and release all the frames
+		"""
+		for worker in self._workers:
+			worker.stop()
+		self.sets.close()
+		for worker in self._workers:
+			worker.join()
+
+		self.sets.clear()
+		with self._lock:
+			for pending in self._pending:
+				while pending: pending.popleft().release()
+
+	@property
+	def failed(self):
+		"""
+		Whether a capture thread has stopped on an error
+		"""
+		return any(worker.failed for worker in self._workers)
+
+	def get(self, timeout=None):
+		"""
+		Take the latest frame set
+
+		Parameters:
+			timeout: maximum waiting time (s), None for no limit
+
+		Return:
+			frames: list of the frames (lib_pipeline.Frame), one for each camera in order, which must be released after use; None if timeout
+		"""
+		return self.sets.get(timeout)
+
+	def _capture(self, idx):
+		"""
+		Capture thread of one camera: grab a frame and try to complete a set
+		"""
+		frame = self.cams[idx].grab()
+		if frame is None: return
+
+		with self._lock:
+			pending = self._pending[idx]
+			pending.append(frame)
+			if len(pending) > self.history:
+				pending.popleft().release()
+				self.dropped += 1
+
+			frames = self._match()
+
+		if frames is not None: self.sets.put(frames)
+
+	def _match(self):
+		"""
+		Match the pending frames into a set, called with the lock held
+
+		Return:
+			frames: the frame set, None if the cameras can not be matched yet
+		"""
+		if not all(self._pending): return None
+
+		# The newest frame of the latest camera is the reference, the other cameras have already captured around it
+		ref = min(pending[-1].stamp for pending in self._pending)
+		frames = [min(pending, key=lambda frame: abs(frame.stamp - ref)) for pending in self._pending]
+
+		stamps = [frame.stamp for frame in frames]
+		if max(stamps) - min(stamps) > self.tolerance:
+			# The frames which can not be matched any more are dropped, i.e. another camera has captured after them without any frame close to them
+			hopeless = [[frame for frame in pending if any(others[-1].stamp > frame.stamp + self.tolerance and all(abs(other.stamp - frame.stamp) > self.tolerance for other in others)
+			                                                for others in self._pending if others is not pending)] for pending in self._pending]
+			for pending, frames in zip(self._pending, hopeless):
+				for frame in frames:
+					pending.remove(frame)
+					frame.release()
+					self.dropped += 1
+			return None
+
+		# The frames before the matched ones are dropped, the ones after wait for the next set
+		for pending, frame in zip(self._pending, frames):
+			while True:
+				item = pending.popleft()
+				if item is frame: break
+				item.release()
+				self.dropped += 1
+
+		return frames
+
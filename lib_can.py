@@ -1,6 +1,8 @@
 # encoding: utf-8
 from ctypes import *
 
+from lib_profiler import profiler
+
 canDLL = cdll.LoadLibrary('./DLL/libcontrolcan.so')
 
 #####################################################
@@ -93,6 +95,7 @@ class  CAN(object):
         else:
             print('CAN {} Start  FAILED \r\n'.format(can_idx))
  
+    @profiler.timed('CAN.Send')
     def Send(self, can_idx, id, frame_len, data):
         """
         Send messages to CAN
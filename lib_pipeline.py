@@ -0,0 +1,169 @@
+import threading
+import traceback
+from collections import deque
+
+
+class LatestSlot(object):
+    """
+    Single-slot (or bounded) queue between two stages, which only keeps the latest items (the stale ones are dropped)
+    """
+    def __init__(self, on_drop=None, size=1):
+        """
+        Init
+
+        Parameters:
+            on_drop: function called with the dropped item, e.g. to release its resources
+            size: number of the latest items kept
+        """
+        self.on_drop = on_drop
+        self.size = size
+        self.dropped = 0
+
+        self._cond = threading.Condition()
+        self._items = deque()
+        self._closed = False
+
+    def put(self, item):
+        """
+        Put an item, replacing the oldest one which has not been taken yet if the slot is full
+
+        Parameters:
+            item: the item, not None
+        """
+        with self._cond:
+            self._items.append(item)
+            stale = self._items.popleft() if len(self._items) > self.size else None
+            self._cond.notify()
+
+        if stale is not None:
+            self.dropped += 1
+            if self.on_drop is not None: self.on_drop(stale)
+
+    def get(self, timeout=None):
+        """
+        Take the oldest kept item (i.e. the latest one for a single slot), waiting for it if the slot is empty
+
+        Parameters:
+            timeout: maximum waiting time (s), None for no limit
+
+        Return:
+            item: None if timeout or closed
+        """
+        with self._cond:
+            if not self._items and not self._closed:
+                self._cond.wait(timeout)
+            item = self._items.popleft() if self._items else None
+
+        return item
+
+    def clear(self):
+        """
+        Drop all the kept items
+        """
+        with self._cond:
+            items = list(self._items)
+            self._items.clear()
+
+        if self.on_drop is not None:
+            for item in items: self.on_drop(item)
+
+    def close(self):
+        """
+        Wake up all the waiting stages, e.g. before stopping the pipeline
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class Worker(threading.Thread):
+    """
+    Thread running one stage of the pipeline in a loop until stopped
+    """
+    def __init__(self, name, step, *args):
+        """
+        Init
+
+        Parameters:
+            name: name of the stage
+            step: function processing one item, which should return in a short time (e.g. using timeouts) to check the stop flag
+            args: arguments of the step function
+        """
+        super(Worker, self).__init__(name=name)
+        self.daemon = True
+        self.step = step
+        self.args = args
+        self.failed = False
+
+        self._stop_event = threading.Event()
+
+    def run(self):
+        """
+        Run the step function until stopped
+        """
+        try:
+            while not self._stop_event.is_set():
+                self.step(*self.args)
+        except Exception:
+            print ("Worker {} failed:".format(self.name))
+            traceback.print_exc()
+            self.failed = True
+
+    def stop(self):
+        """
+        Ask the worker to stop after the current step
+        """
+        self._stop_event.set()
+
+
+class Frame(object):
+    """
+    Frame handed between the stages, which owns its buffer until all the holders have released it
+    """
+    def __init__(self, image, stamp, frame_id=0, on_release=None, offset=(0, 0)):
+        """
+        Init
+
+        Parameters:
+            image: image of the frame (a view of the buffer, no copy)
+            stamp: capture time of the frame (time.monotonic)
+            frame_id: id of the frame
+            on_release: function called when the last holder releases the frame, e.g. to recycle the buffer
+            offset: (x, y) of the image in the full sensor frame, e.g. for a sensor ROI
+        """
+        self.image = image
+        self.stamp = stamp
+        self.frame_id = frame_id
+        self.offset = offset
+
+        self._on_release = on_release
+        self._refs = 1
+        self._lock = threading.Lock()
+
+    def retain(self):
+        """
+        Add a holder of the frame, e.g. before handing it to one more stage
+
+        Return:
+            the frame itself
+        """
+        with self._lock:
+            self._refs += 1
+        return self
+
+    def release(self):
+        """
+        Remove a holder of the frame, the buffer is recycled when no holder is left (the image must not be used afterwards)
+        """
+        with self._lock:
+            self._refs -= 1
+            last = self._refs == 0
+        if last:
+            self.image = None
+            if self._on_release is not None: self._on_release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,199 @@
+import threading
+import functools
+import numpy as np
+from collections import deque
+from time import perf_counter
+
+
+class Span(object):
+    """
+    Timer of one execution of a stage, used as a context manager
+    """
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, perf_counter() - self.start)
+
+
+class NullSpan(object):
+    """
+    Span doing nothing, returned while the profiler is disabled
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_NULL_SPAN = NullSpan()
+
+
+class Profiler(object):
+    """
+    Latency of each stage of the pipeline on the monotonic clock, with the percentiles over a rolling window
+    """
+    def __init__(self, window=1000):
+        """
+        Init
+
+        Parameters:
+            window: number of the recent spans kept for each stage
+        """
+        self.window = window
+        self.enabled = False
+        self.period = None
+        self.csv = None
+
+        self._stages = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._last_report = perf_counter()
+
+    def enable(self, period=None, csv=None):
+        """
+        Start recording
+
+        Parameters:
+            period: print the summary (and dump the csv) every period seconds, None for never
+            csv: path of the csv written at each report
+        """
+        self.period = period
+        self.csv = csv
+        self._last_report = perf_counter()
+        self.enabled = True
+
+    def disable(self):
+        """
+        Stop recording, the recorded spans are kept
+        """
+        self.enabled = False
+
+    def reset(self):
+        """
+        Forget all the recorded spans
+        """
+        with self._lock:
+            self._stages.clear()
+            self._counts.clear()
+
+    def span(self, name):
+        """
+        Time a block of code, e.g. with profiler.span('warp'): ...
+
+        Parameters:
+            name: name of the stage
+
+        Return:
+            span: context manager, which does nothing while disabled
+        """
+        if not self.enabled: return _NULL_SPAN
+        return Span(self, name)
+
+    def timed(self, name):
+        """
+        Decorator timing each call of a function, which only costs one check while disabled
+
+        Parameters:
+            name: name of the stage
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled: return func(*args, **kwargs)
+                start = perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(name, perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def record(self, name, duration):
+        """
+        Record a span
+
+        Parameters:
+            name: name of the stage
+            duration: time cost (s)
+        """
+        # Under the lock: the workers of the pipeline record concurrently
+        with self._lock:
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = deque(maxlen=self.window)
+                self._counts[name] = 0
+            stage.append(duration)
+            self._counts[name] += 1
+
+        if self.period is not None and perf_counter() - self._last_report >= self.period:
+            with self._lock:
+                if perf_counter() - self._last_report < self.period: return
+                self._last_report = perf_counter()
+            self.report()
+
+    def stats(self):
+        """
+        Statistics of each stage over the rolling window
+
+        Return:
+            stats: {name: {"count", "mean", "p50", "p95", "p99", "max"}}, the times in ms
+        """
+        with self._lock:
+            stages = [(name, np.float64(stage), self._counts[name]) for name, stage in self._stages.items()]
+
+        stats = {}
+        for name, times, count in stages:
+            if len(times) == 0: continue
+            times = times * 1000
+            p50, p95, p99 = np.percentile(times, [50, 95, 99])
+            stats[name] = {"count": count, "mean": times.mean(), "p50": p50, "p95": p95, "p99": p99, "max": times.max()}
+
+        return stats
+
+    def summary(self):
+        """
+        Table of the statistics
+
+        Return:
+            text of the table
+        """
+        header = ['stage', 'count', 'mean(ms)', 'p50(ms)', 'p95(ms)', 'p99(ms)', 'max(ms)']
+        lines = [''.join(['{:>24}'.format(header[0])] + ['{:>12}'.format(h) for h in header[1:]])]
+        for name, s in sorted(self.stats().items()):
+            lines.append('{:>24}{:>12}'.format(name, s['count']) + ''.join(['{:>12.3f}'.format(s[k]) for k in ('mean', 'p50', 'p95', 'p99', 'max')]))
+
+        return '\n'.join(lines)
+
+    def dump_csv(self, path):
+        """
+        Save the statistics as csv
+
+        Parameters:
+            path: path of the csv
+        """
+        with open(path, 'w') as f:
+            f.write('stage,count,mean_ms,p50_ms,p95_ms,p99_ms,max_ms\n')
+            for name, s in sorted(self.stats().items()):
+                f.write('{},{},{:.6f},{:.6f},{:.6f},{:.6f},{:.6f}\n'.format(name, s['count'], s['mean'], s['p50'], s['p95'], s['p99'], s['max']))
+
+    def report(self):
+        """
+        Print the summary, and dump the csv if set
+        """
+        print (self.summary())
+        if self.csv is not None: self.dump_csv(self.csv)
+
+
+# Profiler shared by all the modules, disabled by default
+profiler = Profiler()
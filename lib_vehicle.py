@@ -1,6 +1,8 @@
 from lib_can import CAN, UBYTE_ARRAY
 import math
 
+from lib_profiler import profiler
+
 class Vehicle(object):
     """
     Class for the vehicle model and vehicle control
@@ -29,6 +31,7 @@ class Vehicle(object):
         self.steer_ctrl_id = 0x1E2
         self.steer_get_id = 0x33
     
+    @profiler.timed('Vehicle.steer_cal')
     def steer_cal(self, curvature, dist_from_center):
         """
         Calculate the steer according to the curvature of the lane and the distance form the center
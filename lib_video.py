@@ -0,0 +1,175 @@
+import cv2
+import queue
+import atexit
+
+from lib_pipeline import Frame, Worker
+from lib_profiler import profiler
+
+
+class VideoSource(object):
+    """
+    Recorded video as a frame source with the interface of the camera (open / grab / close), decoded ahead by a background thread
+    """
+    def __init__(self, path, queue_size=8, skip=0, start=0, end=None):
+        """
+        Init
+
+        Parameters:
+            path: path of the video
+            queue_size: number of the decoded frames waiting in the queue, the decoder waits when it is full
+            skip: number of the frames skipped (not decoded) after each returned frame, e.g. 1 for every other frame
+            start: index of the first frame
+            end: index after the last frame, None for the end of the video
+        """
+        super(VideoSource, self).__init__()
+        self.path = path
+        self.queue_size = queue_size
+        self.skip = skip
+        self.start = start
+        self.end = end
+        self.cap = None
+        self.fps = 0
+        self.frame_count = 0
+        self.ended = False
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._worker = None
+        # Index of the next frame read from the video
+        self._next = 0
+        self._pending = None
+
+    def open(self):
+        """
+        Open the video and start decoding from the first frame of the range
+
+        Return:
+            False if the video can not be opened
+        """
+        if self.cap is not None:
+            return True
+
+        cap = cv2.VideoCapture(self.path)
+        if not cap.isOpened():
+            print("Can not open the video {}".format(self.path))
+            return False
+
+        self.cap = cap
+        self.fps = cap.get(cv2.CAP_PROP_FPS) or 30.
+        self.frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        # Stop the decoder before the interpreter exits, even if close() is never called (it would be killed inside cap.read())
+        atexit.register(self.close)
+        self.seek(self.start)
+        return True
+
+    def close(self):
+        """
+        Stop the decoder and close the video, the frames already taken stay valid
+        """
+        self._stop_decoder()
+        if self.cap is not None:
+            self.cap.release()
+            self.cap = None
+            atexit.unregister(self.close)
+
+    def seek(self, index):
+        """
+        Restart decoding from a frame, the decoded frames not taken yet are dropped
+
+        Parameters:
+            index: index of the frame
+        """
+        self._stop_decoder()
+
+        # Some containers can not seek: read the frames up to the index instead
+        if index != self._next and not self.cap.set(cv2.CAP_PROP_POS_FRAMES, index):
+            if index < self._next:
+                self.cap.release()
+                self.cap = cv2.VideoCapture(self.path)
+                self._next = 0
+            while self._next < index and self.cap.grab():
+                self._next += 1
+        self._next = index
+        self.ended = False
+
+        self._worker = Worker("decode", self._decode)
+        self._worker.start()
+
+    @profiler.timed('VideoSource.grab')
+    def grab(self, timeout=None):
+        """
+        Take the next decoded frame, waiting for the decoder if the queue is empty
+
+        Parameters:
+            timeout: maximum waiting time (s), None for no limit
+
+        Return:
+            frame: lib_pipeline.Frame, its stamp being the time of the frame in the video (s); None at the end of the range (ended is then set) or if timeout
+        """
+        if self.ended:
+            return None
+
+        try:
+            frame = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+        if frame is None:
+            self.ended = True
+        return frame
+
+    def _decode(self):
+        """
+        Decode one frame into the queue, step of the decoder thread
+        """
+        if self._pending is None:
+            if self.end is not None and self._next >= self.end:
+                ret, image = False, None
+            else:
+                ret, image = self.cap.read()
+
+            if not ret or image is None:
+                # End of the range: None tells the consumer, and the decoder stops
+                self._pending = (None, )
+            else:
+                self._pending = (Frame(image, self._next / self.fps, self._next), )
+                self._next += 1
+                for i in range(self.skip):
+                    if (self.end is not None and self._next >= self.end) or not self.cap.grab(): break
+                    self._next += 1
+
+        # Wait for a free place in the queue, but check the stop flag regularly
+        try:
+            self._queue.put(self._pending[0], timeout=0.2)
+        except queue.Full:
+            return
+        if self._pending[0] is None:
+            self._worker.stop()
+        self._pending = None
+
+    def _stop_decoder(self):
+        """
+        Stop the decoder thread and drop the decoded frames not taken yet
+        """
+        if self._worker is None:
+            return
+
+        self._worker.stop()
+        # Free a place in the queue, the decoder may be waiting for it
+        while self._worker.is_alive():
+            self._drain()
+            self._worker.join(0.05)
+        self._drain()
+        self._worker = None
+        self._pending = None
+
+    def _drain(self):
+        """
+        Drop all the queued frames
+        """
+        while True:
+            try:
+                frame = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if frame is not None:
+                frame.release()
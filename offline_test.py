@@ -2,51 +2,88 @@ import cv2
 import time
 
 from basic_function import show_img
-from lib_LaneDetector import detect_line
+from lib_LaneDetector import LaneTracker, lane_region
 from lib_ObjectDetector import ObjectDetector
+from lib_profiler import profiler
+from lib_video import VideoSource
 
 ######################################################
 ###                 INITIALIZATION                 ###
 ######################################################
 
+# Number of the frames detected together in one batch by Yolo (the results are displayed once the batch is full)
+BATCH = 1
+
+# Latency of each stage: summary printed every 10s and at the end
+PROFILE = False
+if PROFILE: profiler.enable(period=10)
+
+# Range of the replayed frames [START, END) (END None for the whole video), and the number of the frames skipped after each replayed one
+START, END, SKIP = 0, None, 0
+
 # Init the detector
 Detector = ObjectDetector()
 
+# Init the lane tracker
+Tracker = LaneTracker()
+
 ######################################################
 ###                    BEGINING                    ###
 ######################################################
 
-cap = cv2.VideoCapture("./video.mp4")
-
-# lane_fit_memory
-memory = {}
+# The video is decoded ahead by a background thread, while the previous frames are processed
+Source = VideoSource("./video.mp4", queue_size=8, skip=SKIP, start=START, end=END)
+if not Source.open():
+    raise SystemExit
 
 time_tik = 0
 
+# Frames waiting for the batched object detection: (frame, img_result, region)
+window = []
+
 while 1:
     # Video input
-    _, frame = cap.read()
+    frame = Source.grab()
+    # End of the video: the frames left in the window are still detected
+    end = frame is None
+    if end and not window:
+        break
 
     steer = "Can not get steer!"
 
     # Detection Part
     # 1: Lane detection
-    img_result, dist_from_center, curvature, memory, img_area =  detect_line(frame, steer, memory, debug=False)
+    if not end:
+        lane = Tracker.update(frame.image, draw=True)
+        dist_from_center, curvature = lane['distance_from_center'], lane['curvature']
+        img_result, _ = Tracker.render(frame.image, steer)
+        window.append((frame, img_result, lane_region(lane, frame.image.shape)))
+        if len(window) < BATCH:
+            continue
     # 2: Traffic object detection
-    detections = Detector.detect(frame, img_area)
+    detections = Detector.detect_batch([item[0].image for item in window], [item[2] for item in window], BATCH)
     # 3: Merge the detection results
-    img_result = Detector.plot_detections(detections, img_result)
+    quit = False
+    for (frame, img_result, region), result in zip(window, detections):
+        img_result = Detector.plot_detections(result, img_result)
 
-    # Log Part
-    # time_tok = time.time()
-    # time_cost = time_tok - time_tik
-    # time_tik = time_tok
-    # print (dist_from_center, curvature, time_cost)
-    show_img("result", img_result)
-    # show_img("cap", frame)
+        # Log Part
+        # time_tok = time.time()
+        # time_cost = time_tok - time_tik
+        # time_tik = time_tok
+        # print (dist_from_center, curvature, time_cost)
+        show_img("result", img_result)
+        # show_img("cap", frame.image)
 
-    if cv2.waitKey(1) & 0xff == ord('q'):
+        if cv2.waitKey(1) & 0xff == ord('q'):
+            quit = True
+            break
+    for item in window:
+        item[0].release()
+    window = []
+    if quit or end:
         break
 
-cap.release()
+Source.close()
+if profiler.enabled: profiler.report()
 cv2.destroyAllWindows()
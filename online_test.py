@@ -3,27 +3,50 @@ import cv2
 import time
 
 from mvsdk import CameraEnumerateDevice
-from lib_camera import Camera
+from lib_camera import Camera, MultiCamera
 from lib_can import CAN
 from lib_vehicle import Vehicle
 
 from basic_function import show_img
-from lib_LaneDetector import detect_line
-from lib_ObjectDetector import ObjectDetector
+from lib_LaneDetector import LaneTracker, lane_region
+from lib_ObjectDetector import ObjectDetector, AsyncObjectDetector
+from lib_pipeline import LatestSlot, Worker
+from lib_profiler import profiler
 
 ######################################################
 ###                 INITIALIZATION                 ###
 ######################################################
 
+# Headless mode: only the control outputs are computed, without any visualization
+HEADLESS = False
+
+# Callback capture: the camera SDK pushes the frames once they arrive, instead of polling in the capture stage
+CALLBACK = False
+
+# Sensor ROI (x, y, width, height), None for the full sensor; only the rows can be cropped (x = 0, full width)
+# e.g. (0, 1000, 2592, 944) for the lane-only vehicles: the rows above the lane ROI are neither transferred nor processed (the objects there are not detected)
+SENSOR_ROI = None
+
+# MONO8 capture: one byte per pixel for the lane detection, the color is only rebuilt for Yolo & the display
+MONO = False
+
+# Maximum difference between the capture times of the frames of the different cameras in a set (s)
+# About half a frame period, so that the free-running cameras still give a set for every frame
+SYNC_TOLERANCE = 0.02
+
+# Object detection only in the road area plus a margin, at a smaller input size of Yolo
+DETECT_CROP = False
+
+# Latency of each stage: summary printed every 10s and saved in profile.csv
+PROFILE = False
+if PROFILE: profiler.enable(period=10, csv="./profile.csv")
+
 # Init the CAN
 can = CAN()
 
 # Init the vehicle model
 vehicle = Vehicle(wheel_base=2020, width=1655, length=2894, can=can)
 
-# Init the detector
-Detector = ObjectDetector()
-
 # Init the industrial camera
 DevList = CameraEnumerateDevice()
 nDev = len(DevList)
@@ -31,50 +54,127 @@ for i, DevInfo in enumerate(DevList):
 	print("{}: {} {}".format(i, DevInfo.GetFriendlyName(), DevInfo.GetPortType()))
 cams = []
 for i in map(lambda x: int(x), input("Select cameras: ").split()):
-	cam = Camera(DevList[i])
+	cam = Camera(DevList[i], callback=CALLBACK, roi=SENSOR_ROI, mono=MONO)
 	if cam.open():
 		cams.append(cam)
 
+# Capture from all the cameras concurrently, as time-aligned frame sets
+rig = MultiCamera(cams, tolerance=SYNC_TOLERANCE)
+
+# Init the detector, which runs in its own thread and detects the latest frames of all the cameras in one batch
+# (the frames of a set are submitted together, so only a short wait is needed to gather them)
+Detector = AsyncObjectDetector(ObjectDetector(crop=DETECT_CROP), max_batch=len(cams), max_wait=0.005)
+
+# Init the lane trackers, one for each camera
+trackers = [LaneTracker(track=True) for cam in cams]
+
+######################################################
+###                    PIPELINE                    ###
+######################################################
+# capture (MultiCamera, one thread per camera) --> lane (one worker per camera) --> control
+#                                             \-> object (AsyncObjectDetector) <-- lane area
+# The stages are connected by single-slot queues, so that every stage always works on the latest item
+
+# Slots between the stages, the frames (lib_pipeline.Frame) in the dropped items are released
+lane_slots = [LatestSlot(on_drop=lambda item: item["frame"].release()) for cam in cams]
+control_slot = LatestSlot()
+display_slot = LatestSlot(on_drop=lambda item: item["frame"].release())
+
+def capture_step():
+	"""
+	Capture stage: take the latest time-aligned frame set and hand each frame to the lane & object stages of its camera
+	"""
+	frames = rig.get(0.2)
+	if frames is None: return
+
+	# The frame is shared by the lane & object stages without copy, each of them releases it
+	for idx, frame in enumerate(frames):
+		Detector.submit(frame.image, frame.stamp, idx, frame.retain().release)
+		lane_slots[idx].put({"cam": idx, "frame": frame, "stamp": frame.stamp})
+
+def lane_step(idx):
+	"""
+	Lane stage: detect the lane, hand it to the control stage first, and then draw it
+	"""
+	item = lane_slots[idx].get(0.1)
+	if item is None: return
+
+	# try:
+	#     steer = vehicle.steer_get()
+	# except:
+	#     steer = "Can not get steer!"
+	steer = "Can not get steer!"
+
+	frame = item["frame"].image
+	lane = trackers[idx].update(frame, draw=not HEADLESS, y_offset=item["frame"].offset[1])
+	control_slot.put({"cam": idx, "stamp": item["stamp"], "dist_from_center": lane['distance_from_center'], "curvature": lane['curvature']})
+
+	# The object stage only needs the interval table of the road area, no mask image is drawn for it
+	Detector.publish_area(item["stamp"], lane_region(lane, frame.shape), idx)
+
+	if HEADLESS:
+		item["frame"].release()
+	else:
+		img_result, _ = trackers[idx].render(frame, steer)
+		# The display stage takes over the frame
+		display_slot.put({"cam": idx, "frame": item["frame"], "img_result": img_result})
+
+def control_step():
+	"""
+	Control stage: steer according to the freshest lane estimate
+	"""
+	item = control_slot.get(0.1)
+	if item is None: return
+
+	dist_from_center, curvature = item["dist_from_center"], item["curvature"]
+	if dist_from_center==None: dist_from_center = 0.0
+	vehicle.steer_cal(curvature*1000, dist_from_center*100)
+	vehicle.steer_ctrl()
+
+	# Log Part: latency from the capture to the CAN transmission
+	latency = time.monotonic() - item["stamp"]
+	if profiler.enabled: profiler.record('capture_to_control', latency)
+	print (item["cam"], dist_from_center, curvature, "latency {:.1f}ms".format(latency*1000))
+
 ######################################################
 ###                    BEGINING                    ###
 ######################################################
 
-memory = {"left_fit":[0.0, 0.0, 0.0], "right_fit":[0.0, 0.0, 0.0], "left_x":0.0, "right_x":0.0}
-time_tik = 0
+workers = [Worker("capture", capture_step)]
+workers += [Worker("lane{}".format(i), lane_step, i) for i in range(len(cams))]
+workers += [Worker("control", control_step)]
+rig.start()
+for worker in workers:
+	worker.start()
+Detector.start()
 
+# The main thread only displays the results
 while (cv2.waitKey(1) & 0xFF) != ord('q'):
-	for cam in cams:
-		frame = cam.grab()
-		if frame is not None:
-
-			# try:
-			#     steer = vehicle.steer_get()
-			# except:
-			#     steer = "Can not get steer!"
-			steer = "Can not get steer!"
-
-			# Detection Part
-			# 1: Lane detection
-			img_result, dist_from_center, curvature, memory, img_area =  detect_line(frame, steer, memory, debug=False)
-			# 2: Traffic object detection
-			detections = Detector.detect(frame, img_area)
-			# 3: Merge the detection results
-			img_result = Detector.plot_detections(detections, img_result)
-			
-			# Control Part
-			if dist_from_center==None: dist_from_center = 0.0
-			vehicle.steer_cal(curvature*1000, dist_from_center*100)
-			vehicle.steer_ctrl()
-
-			# Log Part
-			time_tok = time.time()
-			time_cost = time_tok - time_tik
-			time_tik = time_tok
-			print (dist_from_center, curvature, time_cost)
-			show_img("result", img_result)
-			show_img("cap", frame)
+	if any(worker.failed for worker in workers) or rig.failed or Detector.failed:
+		break
+
+	item = display_slot.get(0.1)
+	if item is not None:
+		img_result = item["img_result"]
+		detections = Detector.latest(item["cam"])
+		if detections is not None:
+			img_result = Detector.detector.plot_detections(detections[1], img_result)
+		show_img("result", img_result)
+		show_img("cap", item["frame"].image)
+		item["frame"].release()
+
+for worker in workers:
+	worker.stop()
+for slot in lane_slots + [control_slot, display_slot]:
+	slot.close()
+for worker in workers:
+	worker.join()
+rig.stop()
+Detector.stop()
 
 for cam in cams:
 	cam.close()
 
+if profiler.enabled: profiler.report()
+
 cv2.destroyAllWindows()
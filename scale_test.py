@@ -0,0 +1,97 @@
+import cv2
+import time
+import argparse
+import numpy as np
+
+from lib_LaneDetector import LaneTracker
+
+######################################################
+###                   FUNCTIONS                    ###
+######################################################
+
+def load_frames(video, max_frames):
+    """
+    Load the frames of the video, so that every scale runs on the same frames without decoding
+
+    Parameters:
+        video: path of the video
+        max_frames: maximum number of frames to load
+
+    Return:
+        frames: list of the frames
+    """
+    cap = cv2.VideoCapture(video)
+    frames = []
+    while len(frames) < max_frames:
+        ret, frame = cap.read()
+        if not ret or frame is None:
+            break
+        frames.append(frame)
+    cap.release()
+
+    return frames
+
+def run_scale(frames, scale, refine):
+    """
+    Run the lane tracker on the frames
+
+    Parameters:
+        frames: list of the frames
+        scale: downscaling factor
+        refine: refine the fits at the full resolution
+
+    Return:
+        results: [distance_from_center, curvature, left line x, right line x] of each frame (line x at the bottom of the bev)
+        times: time cost of each frame (s)
+    """
+    tracker = LaneTracker(scale=scale, refine=refine)
+    results, times = [], []
+    for frame in frames:
+        time_tik = time.time()
+        lane = tracker.update(frame)
+        times.append(time.time() - time_tik)
+
+        y_base = lane['warp'].bev_size[1] - 1
+        dist = lane['distance_from_center']
+        results.append([np.nan if dist is None else dist, lane['curvature'], np.polyval(lane['left_fit'], y_base), np.polyval(lane['right_fit'], y_base)])
+
+    return np.float64(results), np.float64(times)
+
+######################################################
+###                    BEGINING                    ###
+######################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Accuracy & speed of the lane detection at different processing scales")
+    parser.add_argument('--video', default="./video.mp4", help="recorded video")
+    parser.add_argument('--scales', default=[1, 2, 4], type=int, nargs='+', help="downscaling factors to compare")
+    parser.add_argument('--frames', default=300, type=int, help="maximum number of frames")
+    parser.add_argument('--csv', default=None, help="save the report as csv")
+    args = parser.parse_args()
+
+    frames = load_frames(args.video, args.frames)
+    if not frames:
+        raise SystemExit("No frame in {}".format(args.video))
+
+    # The full resolution is the reference
+    ref, _ = run_scale(frames, 1, False)
+
+    rows = []
+    for scale in args.scales:
+        for refine in ([False] if scale == 1 else [False, True]):
+            res, times = run_scale(frames, scale, refine)
+
+            dist_err = np.abs(res[:, 0] - ref[:, 0])
+            curv_err = np.abs(res[:, 1] - ref[:, 1]) / np.abs(ref[:, 1])
+            line_err = np.abs(res[:, 2:] - ref[:, 2:])
+            rows.append([scale, int(refine), np.nanmean(dist_err), np.nanpercentile(dist_err, 95), np.nanmedian(curv_err), np.nanmean(line_err),
+                         np.mean(times)*1000, np.percentile(times, 95)*1000, 1/np.mean(times)])
+
+    header = ['scale', 'refine', 'dist_err_mean(m)', 'dist_err_p95(m)', 'curv_err_median', 'line_err_mean(px)', 'time_mean(ms)', 'time_p95(ms)', 'fps']
+    print("{} frames of {}".format(len(frames), args.video))
+    print(''.join(['{:>19}'.format(h) for h in header]))
+    for row in rows:
+        print(''.join(['{:>19.4f}'.format(v) for v in row]))
+
+    if args.csv:
+        np.savetxt(args.csv, np.float64(rows), fmt='%.6f', delimiter=',', header=','.join(header), comments='')